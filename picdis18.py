@@ -2,24 +2,107 @@
 Claudiu.Chiculita@ugal.ro    http://www.ac.ugal.ro/staff/ckiku/software/
 Modified: kjellc, 2025
 
-picdis18.py  [-h] [-l] [-int1] [-int2] [-d dbfile] [-o outputfile] file.hex
+picdis18.py  [-h] [-l] [-int1] [-int2] [--device part] [-d dbfile] [-o outputfile] file.hex
+picdis18.py  -b [-w workers] [-h] [-l] [-int1] [-int2] [--device part] [-d dbfile] file.hex|'*.hex' ...
+picdis18.py  --serve socket|port [-w workers] [-d dbfile]
 
-file.hex   input .HEX file in Intel format
+file.hex   input .HEX file in Intel format, or an ELF / Microchip COFF file,
+           or a raw program memory image file.bin
 file_.asm  default output file, containing the assembly instructions, SFR names
            directives, branch/call labels, callers of procedures, comments
--o      save result to the specified file
+-o      save result to the specified file, - for stdout
 -h      0xHH syle for hex numbers (default is: HHh)
 -l      lists addresses and binary code of instructions
 --int1  dissasembly interrupt 1 entry point
 --int2  dissasembly interrupt 2 entry point
 -d      use specified db definitions file (see example_db.txt for details)
--j file Use jump-table definition file
+--device part  PIC18 part of the SFR and config names (default 18F47Q10),
+        from the device database devices18.txt
+-j file Use jump-table definition file, lines start,stop[,code|data[,name]]
+-b      batch mode, disassemble all given files (or glob patterns) in parallel,
+        each into file_.asm, and print a summary
+-w n    number of worker processes for batch mode (default: cpu count)
+--no-cache  do not use the result cache (see PICDIS18_CACHE, PICDIS18_CACHE_SIZE)
+--watch do it again each time file.hex changes, reusing the unchanged lines
+--graph file  write the control flow graph, DOT if file ends with .dot, else JSON
+--base addr   load address (hex) of a raw .bin image (default 0)
+--stats print the wall time and peak memory of each phase, and work counters
+--stats-json file  same as --stats, and write the report to file as JSON
+--profile file  write a cProfile dump of the run to file
+--export file  write the analysis as JSON Lines, or NumPy arrays if file ends
+        with .npz (see `Disassembler.iter_records`, `write_npz`)
+--serve socket|port  server mode: keep the tables loaded and disassemble the
+        files POSTed to /disassemble on a Unix socket or localhost port
+        (see `serve_request` for the options), -w worker processes
 Can be loaded into MPLAB and reassembled immediatedly without any problems!
 although the processor type should be changed (default 18F47Q10)
 """
 # The assigned labels contain the hex address of the instruction
 # ToDo: + clean code + bitnames
 #------------------History---------------------------
+# v0.7:
+#  - Opcodes are decoded with a 64K lookup table, cached on disk
+#      (~/.cache/picdis18 or $PICDIS18_CACHE)
+#  - Opcode templates are compiled once into format strings + operand fields
+#  - Faster Intel HEX reader, program memory and eeprom are loaded into flat
+#      byte images; bytes are placed at their real address, so records
+#      starting or ending on an odd address no longer create odd entries.
+#      Output change: a table pointer load of an odd address is now marked
+#      INVALID and keeps its literal operands (it was given a table label
+#      that never appeared), and the bogus eeprom 'ORG 310003h' line is gone
+#  - Program memory is kept in flat word arrays (Program) instead of one
+#      Instruction object per word, labels/comments/callers are sparse tables
+#  - db definitions are matched together in one pass (Aho-Corasick)
+#  - Batch mode (-b, -w) to disassemble many files with a process pool
+#  - Disassembler class, the per-image state is kept in the instance and the
+#      definition tables are loaded once and shared (get_definitions), so the
+#      disassembler can be imported and used from several threads
+#  - Result cache: rendered files are kept in ~/.cache/picdis18/results keyed
+#      by the hex contents and options, repeated runs just copy them (--no-cache)
+#  - Incremental re-disassembly (Disassembler.update, --watch): the analysis is
+#      patched, the coverage of the changed blocks and of the blocks no longer
+#      reached is walked again, the blocks, banks, table pointers, db matches,
+#      labels and callers are redone only around what moved; the rendered lines
+#      of the unchanged parts are reused. A change of the programmed addresses,
+#      or a patch reaching dummies or nil runs, falls back to a full analyze
+#  - Output is generated line by line (iter_lines) and written in large chunks,
+#      to any file object; -o - writes to stdout
+#  - Banked SFR names come from a bank dataflow over the covered code; where
+#      paths with different banks join no name is given (was: first path wins)
+#  - Basic blocks and control flow graph built from the coverage (build_cfg),
+#      exported with --graph as DOT or JSON with the call graph
+#  - Each covered instruction is decoded once (decode), branch destinations are
+#      kept per address (Program.dest); the CFG and bank passes reuse them
+#  - Jump-table file ranges are kept as merged intervals (RangeSet) walked
+#      directly by the coverage, with optional kind (code/data) and name
+#  - ELF and Microchip COFF object files, raw .bin images (--base); a raw image
+#      from address 0 is memory-mapped and used in place
+#  - Phase timings, peak memory and work counters (--stats, --stats-json),
+#      cProfile dump (--profile); the peak memory is read with getrusage, or
+#      traced with tracemalloc only when PYTHONTRACEMALLOC is set
+#  - Code coverage worklist is an array of addresses, covered addresses are not
+#      pushed and a waiting one is moved up instead of pushed again; the walk
+#      decodes inline (was: one StackItem per edge and assembly_line)
+#  - Device database (devices18.txt, --device): SFR and config names and
+#      memory ranges per part, compiled once into an indexed file in the cache
+#      from which only the selected part is loaded; the definition files are
+#      found next to picdis18.py when not in the current directory; the
+#      PROCESSOR directive names the selected part
+#  - Server mode (--serve): asyncio HTTP server on a Unix socket or localhost
+#      port with a pool of warm workers, returns the assembly or JSON with the
+#      request timing (Server-Timing header)
+#  - Structured export of the analysis (--export): JSON Lines records of the
+#      lines, labels, callers, tables, db matches and config, or NumPy .npz
+#      columns (numpy is optional)
+#  - Runs of unprogrammed words are covered at once (was: word by word, up to
+#      the 20 bit wrap around) and kept as address ranges (Program.nil_runs),
+#      also past the end of the image; each run is one basic block, its
+#      words are not decoded one by one
+#  - Cross reference index (Disassembler.xrefs, XrefIndex): sorted arrays of
+#      (target, source, kind) answering callers of, references into a range
+#      and references of a function; branch/call destinations outside of the
+#      image are kept apart (code.external) and get an EQU label, instead of
+#      a dummy nil word line and a coverage walk from them
 # v0.6:
 #  - Fixed problem reading 1 byte intel-hex records
 #  - Corrected regnames.txt for 18F47K40, 18F45Q40 etc.
@@ -42,35 +125,188 @@ although the processor type should be changed (default 18F47Q10)
 #Free for any use providing this notice is retained in the code.
 #Use this code at your own risk.
 
-import getopt, os, sys, string, re
+import getopt, os, sys, string, re, hashlib, glob, time, threading, shutil, json, heapq, bisect, mmap, struct, pickle, copy
+import tracemalloc, cProfile, asyncio, io, urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+try:
+    import numpy                        # optional, only the .npz export needs it
+except ImportError:
+    numpy = None
+try:
+    import resource                     # peak memory of --stats, not on Windows
+except ImportError:
+    resource = None
 
 debug = 0
 tabsize = 4
-listing = 0    # =1 => only 1 asm line per each addr. ( -empty +nil )
-hexstyle = 0   # 0 = 0NNh, 1 = 0xNN - kjc: changed default
 dbstyle = 1    # 0 = hex, 1 = dec
 
-code = {}       # key=(even addresses),  value=Instruction(s)
-eeprom = {}
-configuration = {}
-covered = {}
-max_addr = 0    # top address loaded by the hex file
-stack = []      # store addresses for code coverage analyze
-conf_regs = {}  # key = config address, value = config register name
+opcodes_file = 'opcodes18.txt'
+regnames_file = 'regnames18.txt'
+confregs_file = 'confregs18.txt'
+devices_file = 'devices18.txt'     # device database source, see `load_device`
+default_device = '18F47Q10'
+data_dir = os.path.dirname(os.path.abspath(__file__))  # definition files not found in the current directory are read from here
+cache_dir = os.environ.get('PICDIS18_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'picdis18'))
+result_cache_dir = os.path.join(cache_dir, 'results')                  # rendered .asm files, see `result_cache_get`
+result_cache_size = int(os.environ.get('PICDIS18_CACHE_SIZE', 64 << 20))    # bytes, least recently used are evicted
+source_digest = None    # hash of this program, part of the result cache key
+bank_unknown = 0x10     # bank of an address reached with different banks (see `analyze_banks`)
+dead_entry = -1 << 62   # cleared slot of the code coverage worklist (see `Disassembler.push`)
+tblptr_names = {0x6EF6: (' tblptrl ', ' L ADDR '), 0x6EF7: (' tblptrh ', ' H ADDR '), 0x6EF8: (' tblptru ', ' U ADDR ')}
+
+class Program:
+    # Columnar program memory model, word arrays are indexed by (addr >> 1).
+    # Per word state is kept in flat arrays, everything else lives in sparse
+    # tables holding only the entries that exist.
+    def __init__(self, region):
+        n = len(region.data) >> 1
+        if (sys.byteorder == 'little'):
+            self.words = memoryview(region.data).cast('H')  # taken from hex, no copy (may be a mapped file)
+        else:
+            self.words = array('H', bytes(region.data))
+            self.words.byteswap()
+        p = region.present                              # 1 = word has a programmed byte
+        self.present = (int.from_bytes(p[0::2], 'little') | int.from_bytes(p[1::2], 'little')).to_bytes(n, 'little')
+        self.covered = bytearray(n)     # 1 = reached by the code coverage analyze
+        self.length = bytearray(n)      # bytes of the instruction (2 or 4) or db line (upto 16)
+        self.dummy = {}                 # key=address not in hex (strange jumps, missing dword half), read as 0xffff
+                                        # value=True once decoded by the coverage analyze
+        self.covered_extra = set()      # covered dummies outside of `covered`
+        self.nil_runs = {}              # key=start of a covered run of nil words (not programmed, no dummy),
+                                        # value=address after it, see `walk_blank`
+        self.nil_extra = []             # (start, end) of the nil runs outside of `covered`
+        self.calls = {}                 # key=address, value=list of callers/(jumpers)
+        self.labels = {}                # key=address, value=label
+        self.comments = {}              # key=address, value=comment text (without ';')
+        self.prefixlines = {}           # key=address, value=text written before the line
+        self.asm = {}                   # key=address, value=replaced instruction text
+        self.dest = {}                  # key=address of a covered branch/call, value=its destination
+        self.external = {}              # key=destination outside of the image, value=list of branches/calls to it
+        self.blocks = {}                # key=start address, value=BasicBlock, see `build_cfg`
+        self.bank_in = {}               # key=block start, value=bank at the entry of the block, see `analyze_banks`
+        self.tables = {}                # key=table address, value=list of the (upper, high, low) movlw/addlw
+                                        # loading it, see `analyze_table_pointers`
+        self.matches = []               # (byte address, table_defs index) of the db definitions found
+
+    # True if there is a word at `addr`, either loaded from the hex file
+    # or a dummy one added by `lookup_adr`
+    def in_code(self, addr):
+        if ((addr >= 0) and ((addr & 1) == 0) and ((addr >> 1) < len(self.present)) and self.present[addr >> 1]):
+            return True
+        return addr in self.dummy
+
+    # Return the word at `addr` (0xffff for dummies and unprogrammed words)
+    def word_at(self, addr):
+        if ((addr >= 0) and ((addr & 1) == 0) and ((addr >> 1) < len(self.present)) and self.present[addr >> 1]):
+            return self.words[addr >> 1]
+        return 0xffff
+
+    def lookup_adr(self, addr):
+        if (not self.in_code(addr)):     # exceptional case: a jump to a location not defined in hexfile
+            self.dummy[addr] = False     #                    or a missing second word in a dword instr
+        return self.word_at(addr)
+
+    def is_covered(self, addr):
+        if ((addr >= 0) and ((addr & 1) == 0) and ((addr >> 1) < len(self.covered))):
+            return self.covered[addr >> 1] != 0
+        if (addr in self.covered_extra):
+            return True
+        return any(((start <= addr) and (addr < end)) for start, end in self.nil_extra)
+
+    def set_covered(self, addr):
+        if ((addr >= 0) and ((addr & 1) == 0) and ((addr >> 1) < len(self.covered))):
+            self.covered[addr >> 1] = 1
+        else:
+            self.covered_extra.add(addr)
 
-table_defs = []  # store TableDef's
+    def is_code(self, addr):
+        return self.in_code(addr) and self.is_covered(addr)
 
-class Instruction:
-    def __init__(self):
-        self.bin = 0        # taken from hex
-        self.dummy = 0      # strange jumps, ORGs
-        self.calls = []     # list of callers/(jumpers)
-        self.asm = ''
-        self.label = '    '
-        self.prefixline = ''
-        self.comment = ';'
-        self.bytes = 0      # operand length in bytes (2, 4 or 16 for db's)
-        self.stop = False
+    def add_call(self, dest, addr):
+        if (dest in self.calls):
+            self.calls[dest].append(addr)
+        else:
+            self.calls[dest] = [addr]
+
+    def add_external(self, dest, addr):
+        if (dest in self.external):
+            self.external[dest].append(addr)
+        else:
+            self.external[dest] = [addr]
+
+    def add_comment(self, addr, txt):
+        self.comments[addr] = self.comments.get(addr, '') + txt
+
+    # Return the map of the decoded words, indexed by (addr >> 1):
+    # 1 = covered and programmed, or a covered dummy; 0 = not covered or nil
+    def code_map(self):
+        n = len(self.present)
+        codemap = bytearray((int.from_bytes(self.present, 'little') & int.from_bytes(self.covered, 'little')).to_bytes(n, 'little'))
+        for a in self.dummy:
+            if ((a >= 0) and ((a & 1) == 0) and ((a >> 1) < n) and self.is_covered(a)):
+                codemap[a >> 1] = 1
+        return codemap
+
+    # Yield every decoded address (the covered instructions, not the nil
+    # runs), ascending
+    def covered_addresses(self):
+        codemap = self.code_map()
+        for a, decoded in self.dummy.items():
+            if ((not decoded) and (a >= 0) and ((a & 1) == 0) and ((a >> 1) < len(codemap))):
+                codemap[a >> 1] = 0     # a destination in a nil run, covered with it
+        if (not self.covered_extra):
+            return self.covered_runs(codemap)
+        return heapq.merge(self.covered_runs(codemap), sorted(self.covered_extra))
+
+    # Yield the addresses of the words set in the map `covered`, ascending
+    def covered_runs(self, covered):
+        pos = 0
+        while True:
+            i = covered.find(1, pos)            # start of a run of covered words
+            if (i < 0):
+                break
+            j = covered.find(0, i)              # end of this run
+            if (j < 0):
+                j = len(covered)
+            yield from range(i * 2, j * 2, 2)
+            pos = j
+
+    # Yield every address in code (programmed words and dummies) from
+    # `start` up to `end` (None = all), ascending
+    def addresses(self, start=0, end=None):
+        present = self.present
+        dummies = sorted(a for a in self.dummy if ((a >= start) and ((end is None) or (a < end))))
+        stop = len(present) if (end is None) else max(0, min(len(present), (end + 1) >> 1))
+        k = 0
+        pos = max(0, (start + 1) >> 1)
+        while True:
+            i = present.find(1, pos, stop)      # start of a run of programmed words
+            if (i < 0):
+                break
+            j = present.find(0, i, stop)        # end of this run
+            if (j < 0):
+                j = stop
+            for addr in range(i * 2, j * 2, 2):
+                while ((k < len(dummies)) and (dummies[k] < addr)):
+                    yield dummies[k]
+                    k += 1
+                yield addr
+            pos = j
+        while (k < len(dummies)):
+            yield dummies[k]
+            k += 1
+
+    # Return the program words as little endian bytes, from word index
+    # `start` up to `end` (None = all)
+    def code_bytes(self, start=0, end=None):
+        data = self.words[start:end].tobytes()
+        if (sys.byteorder == 'big'):
+            data = bytearray(data)
+            data[0::2], data[1::2] = data[1::2], data[0::2]
+            data = bytes(data)
+        return data
 
 class Opcode:
     def __init__(self):
@@ -79,42 +315,176 @@ class Opcode:
         self.mask = 0
         self.skip = False
         self.stop = False
+        self.bytes = 2          # instruction length, 4 for dword templates (W, Y, Z)
+        self.banked = False     # has a register-file operand (F)
+        self.target = None      # field(addr, w, w2) returning the branch destination (N, M, W)
+        self.call = False       # the target is called (call, rcall), execution continues after
+        self.variant_mask = 0   # bits of the word selecting an entry in `formats`
+        self.formats = {}       # key=(w & variant_mask), value=(format string, list of fields)
 
 class StackItem:
     def __ini__(self):
         self:addr = 0
         self:bank = 0
 
+class Region:
+    def __init__(self, base, size):
+        self.base = base                # address of data[0]
+        self.data = bytearray(size)     # byte values, 0 where not programmed
+        self.present = bytearray(size)  # presence map, 1 = byte programmed by the hex file
+
+class RangeSet:
+    # Interval set of inclusive (start, stop) address ranges, kept sorted;
+    # overlapping and adjacent ranges are merged. Starts are word aligned.
+    def __init__(self, ranges=()):
+        self.starts = []
+        self.stops = []
+        for start, stop in sorted((start & ~1, stop) for start, stop in ranges):
+            if (self.stops and (start <= self.stops[-1] + 1)):
+                self.stops[-1] = max(self.stops[-1], stop)
+            else:
+                self.starts.append(start)
+                self.stops.append(stop)
+
+    def __contains__(self, addr):
+        i = bisect.bisect_right(self.starts, addr) - 1
+        return (i >= 0) and (addr <= self.stops[i])
+
+    def __iter__(self):
+        return zip(self.starts, self.stops)
+
+    def __len__(self):
+        return len(self.starts)
+
+    # Return the first address of the ranges from `lo` up to `hi`, else `hi`
+    def first(self, lo, hi):
+        i = bisect.bisect_left(self.stops, lo)
+        if ((i < len(self.starts)) and (self.starts[i] < hi)):
+            return max(lo, self.starts[i])
+        return hi
+
+    # Yield the word addresses of all ranges, ascending (or descending)
+    def addresses(self, reverse=False):
+        if (reverse):
+            for start, stop in zip(reversed(self.starts), reversed(self.stops)):
+                yield from range(stop - ((stop - start) & 1), start - 1, -2)
+        else:
+            for start, stop in zip(self.starts, self.stops):
+                yield from range(start, stop + 1, 2)
+
+class XrefIndex:
+    # Cross references (target, source, kind) of the analyzed code, kept in
+    # flat arrays sorted by target and by source, for range queries with
+    # bisect (see `Disassembler.xrefs`). The references to destinations
+    # outside of the image are only in `external`.
+    kinds = ('branch', 'call', 'table')
+
+    def __init__(self, refs, external):
+        refs = sorted(refs)             # (target, source, kind index)
+        self.targets = array('q', [r[0] for r in refs])
+        self.sources = array('q', [r[1] for r in refs])
+        self.kind = bytes(r[2] for r in refs)
+        order = sorted(range(len(refs)), key=lambda i: (refs[i][1], refs[i][0]))
+        self.by_source = array('q', order)                          # indexes of refs ordered by source
+        self.source_keys = array('q', [refs[i][1] for i in order])
+        self.external = external        # key=destination outside of the image, value=sorted sources
+
+    def __len__(self):
+        return len(self.targets)
+
+    def ref(self, i):
+        return self.targets[i], self.sources[i], self.kinds[self.kind[i]]
+
+    # (target, source, kind) of the references to `start` <= target < `end`
+    def refs_into(self, start, end):
+        lo = bisect.bisect_left(self.targets, start)
+        hi = bisect.bisect_left(self.targets, end, lo)
+        return [self.ref(i) for i in range(lo, hi)]
+
+    # (target, source, kind) of the references from `start` <= source < `end`
+    def refs_from(self, start, end):
+        lo = bisect.bisect_left(self.source_keys, start)
+        hi = bisect.bisect_left(self.source_keys, end, lo)
+        return [self.ref(self.by_source[i]) for i in range(lo, hi)]
+
+    # (source, kind) of the references to `addr`
+    def callers(self, addr):
+        return [(source, kind) for target, source, kind in self.refs_into(addr, addr + 1)]
+
+    # Return the index with the references from the addresses `sources`
+    # replaced by `refs` (target, source, kind index)
+    def replace(self, sources, refs, external):
+        kept = [(t, s, k) for t, s, k in zip(self.targets, self.sources, self.kind) if (s not in sources)]
+        return XrefIndex(kept + refs, external)
+
 class TableDef:
     def __init__(self):
         self.comment = ''
         self.data = []
 
+class BasicBlock:
+    # Straight run of covered instructions, entered only at `start`.
+    # Edge kinds: 'next' (fall through), 'branch', 'skip', 'call'
+    def __init__(self, start):
+        self.start = start
+        self.end = start        # address after the last instruction
+        self.last = start       # address of the last instruction
+        self.succ = []          # (address, kind) of the following blocks
+        self.pred = []          # (address, kind) of the preceding blocks, callers included
+        self.calls = []         # addresses called from the block
+        self.events = []        # (address, word) of the movlb, banked and call instructions, in order
+
+class Device:
+    # The definitions of one PIC18 part, from the device database
+    # (see `load_device`)
+    def __init__(self, entry):
+        self.name = entry['name']
+        self.flash = entry['flash']             # (start, stop) byte addresses of the program memory
+        self.eeprom = entry['eeprom']           # (start, stop) byte addresses of the data eeprom
+        self.reg_names = entry['reg_names']     # key=SFR address, value=name
+        self.conf_regs = entry['conf_regs']     # key=config byte address, value=name
+        self.digest = entry['digest']           # hash of the device sources
+
+class Definitions:
+    # The definition tables, read-only once loaded and shared by
+    # every Disassembler (see `get_definitions`). The register names come
+    # from the device database, or from the given name files
+    def __init__(self, opcodes=opcodes_file, regnames=None, confregs=None, device=default_device):
+        opcodes = data_path(opcodes)
+        self.device = load_device(device)
+        h = hashlib.sha1(self.device.digest.encode())
+        for path in (opcodes, regnames, confregs):
+            if (path):
+                f = open(data_path(path), "rb")
+                h.update(f.read())
+                f.close()
+        self.digest = h.hexdigest()     # identifies the definition files (result cache key)
+        self.operand_table = make_operand_table(opcodes)
+        self.decode_table = load_decode_table(self.operand_table, opcodes)
+        self.reg_names = read_registry_names(data_path(regnames)) if (regnames) else self.device.reg_names
+        self.conf_regs = read_conf_regs(data_path(confregs)) if (confregs) else self.device.conf_regs
+
+    # Return the assembly-language template string
+    # that matches a given binary instruction word
+    def matching_opcode(self, w):
+        i = self.decode_table[w]
+        if (i != 0xFF):
+            return self.operand_table[i]
+        return unknown_opcode                   # unidentifiable binary -- punt
+
+definitions = {}        # key=(opcodes, regnames, confregs, device), value=Definitions
+definitions_lock = threading.Lock()
+
 ###################################################################
-def hexc(nr):            #custom hex()
-    if (hexstyle):
-        if (nr < 10):
-            return str(int(nr))
-        return '0x%X' % int(nr)    # C syle
-    else:
-        if (nr < 10):
-            return str(int(nr))    # ASM style
-        t = '%Xh' % int(nr)
-        if (t[0] in string.ascii_letters):
-            t = '0' + t
-        return t
-
-## kjc: custom hex v2
-def hexc2(nr):
-    if (hexstyle):
-        if (nr < 10):
-            return str(int(nr))
-        return '0x%02X' % int(nr)    # C syle
-    else:
-        t = '%Xh' % int(nr)
-        if (t[0] in string.ascii_letters):
-            t = '0' + t
-        return t
+# Return the Definitions for the given files and device, loaded on
+# first use and shared afterwards
+#
+def get_definitions(opcodes=opcodes_file, regnames=None, confregs=None, device=default_device):
+    key = (opcodes, regnames, confregs, device_key(device))
+    with definitions_lock:
+        if (key not in definitions):
+            definitions[key] = Definitions(opcodes, regnames, confregs, device)
+        return definitions[key]
 
 ###################################################################
 def makelabel(nr):
@@ -127,74 +497,205 @@ def maketablelabel(nr):
     return 't' + s.rjust(6).replace(' ', '_')
 
 ###################################################################
-# Reads an Intel HEX file into the `code` dictionary
-# the keys are addresses and code[].bin has the object code
+# Build a Region starting at `base` from a list of (address, bytes) records
 #
-def read_object_code(objectfile):
-    global code, conf_regs
-    exta = '0000'                          # prefix for extended addr
-    for x in objectfile.readlines():
-        if debug:
-            print(x[:-1])
-        if x[0] == ':':                    # Intel form        :CCAAAATTllhhllhh....rr
-            x = x.strip()
-            nb = int(x[1:3], 16)           # number of bytes this record
-            ad = int(exta + x[3:7], 16)    # starting word address this record + extended linear
-            ty = int(x[7:9], 16)           # record type
-            if debug:
-                print(string.rjust(hexc(ad),8), ty, x)
-            if ty == 0:
-                pass
-            elif ty == 1:
-                break                       # end of record
-            elif ty == 4:                   # extended linear, only :02000004aaaa  supported
-                exta = x[9:13];
-                continue
-            else:
-                print("Not a data record")
-                continue                    # not a data record - ignore it
-            teco = {}                       # temporary code
-            cks = nb + (ad & 0xFF) + ((ad >> 8) & 0xFF) + ty    # init checksum
-            dd = x[9:-2]                    # isolate the data
-
-            # dd = one row from hex file, data bytes
-            #print(conf_regs)
-
-            while dd:
-
-                if (ad in conf_regs):
-                    configuration[ad] = int(dd[0:2], 16)
-
-                if ((ad & 1) == 0 or nb <= 1):
-                    #print("ad=", hex(ad), " dd=", dd)
-                    if (nb > 1):
-                        d = int(dd[0:2], 16), int(dd[2:4], 16) # convert 2 bytes
-                        teco[ad & ~1] = Instruction()          # add a new key = address
-                        teco[ad & ~1].bin = (d[1] << 8) + d[0] # write a word in code
-                    else:
-                        d = int(dd[0:2], 16)                   # convert last byte
-                        teco[ad] = Instruction()               # add a new key = address
-                        teco[ad].bin = d                       # write a byte in code
+def make_region(base, records):
+    top = base
+    for ad, dd in records:
+        top = max(top, ad + len(dd))
+    region = Region(base, (top - base + 1) & ~1)     # whole words
+    for ad, dd in records:
+        o = ad - base
+        region.data[o:o + len(dd)] = dd
+        region.present[o:o + len(dd)] = b'\x01' * len(dd)
+    return region
 
-                cks += int(dd[0:2], 16)                       # update checksum
-                ad += 1                                       # bump the code address
-                dd = dd[2:]                                   # drop one byte
-                nb -= 1
+###################################################################
+# Return the contents of the open binary file `f`, memory-mapped
+# read-only (no copy) when possible
+#
+def map_file(f):
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):       # empty file, or not a regular file
+        return f.read()
 
-            if ((int(x[-2:], 16) + cks) & 0xFF != 0):         # verify the checksum
-                raise ValueError((hexc(-cks), hexc(int(x[-2:], 16))))
+###################################################################
+# Return the format of the object file contents `data` named `name`:
+# 'elf', 'coff' (Microchip COFF), 'bin' (raw program memory image, by
+# the .bin extension) or 'hex' (Intel HEX)
+#
+def input_format(data, name=''):
+    if (os.path.splitext(name)[1].lower() == '.bin'):
+        return 'bin'
+    if (data[:4] == b'\x7fELF'):
+        return 'elf'
+    if (data[:2] in (b'\x34\x12', b'\x40\x12')):     # magic 0x1234 (v1), 0x1240 (v2)
+        return 'coff'
+    return 'hex'
 
-            if (ad < 0x300000):
-                code.update(teco)
-            if ((ad >= 0x310000) and (ad < 0x3f0000)):
-                eeprom.update(teco)
+###################################################################
+# Return the loaded (address, bytes) segments of an ELF file (XC8, MPLAB):
+# the PT_LOAD program headers at their physical address, or the allocated
+# sections if there are none. The bytes are views of `data`
+#
+def elf_segments(data):
+    mv = memoryview(data)
+    if (data[4] not in (1, 2)):
+        raise ValueError('Bad ELF class: %d' % data[4])
+    e = '<' if (data[5] == 1) else '>'
+    if (data[4] == 2):                  # 64 bit
+        phoff, shoff = struct.unpack_from(e + 'QQ', data, 0x20)
+        phentsize, phnum, shentsize, shnum = struct.unpack_from(e + 'HHHH', data, 0x36)
+        ph, sh = e + 'IIQQQQ', e + 'IIQQQQ'
+    else:
+        phoff, shoff = struct.unpack_from(e + 'II', data, 0x1C)
+        phentsize, phnum, shentsize, shnum = struct.unpack_from(e + 'HHHH', data, 0x2A)
+        ph, sh = e + 'IIIIII', e + 'IIIIII'
+    segments = []
+    for i in range(phnum):
+        fields = struct.unpack_from(ph, data, phoff + i * phentsize)
+        if (data[4] == 2):
+            p_type, p_flags, offset, vaddr, paddr, filesz = fields
         else:
-            print("Ignoring line: ", x)                    # ignore anything else
+            p_type, offset, vaddr, paddr, filesz, memsz = fields
+        if ((p_type == 1) and (filesz > 0)):                # PT_LOAD
+            segments.append((paddr, mv[offset:offset + filesz]))
+    if (not segments):
+        for i in range(shnum):
+            name, sh_type, flags, addr, offset, size = struct.unpack_from(sh, data, shoff + i * shentsize)
+            if ((sh_type == 1) and (flags & 2) and (size > 0)):     # SHT_PROGBITS, SHF_ALLOC
+                segments.append((addr, mv[offset:offset + size]))
+    return segments
+
+###################################################################
+# Return the (address, bytes) segments of a Microchip COFF file (MPLINK,
+# XC8 .cof): the program memory sections (text, rom data) with raw data.
+# The bytes are views of `data`
+#
+def coff_segments(data):
+    mv = memoryview(data)
+    magic, nscns, timdat, symptr, nsyms, opthdr, flags = struct.unpack_from('<HHIIIHH', data, 0)
+    sh = '<8sIIIIIIHHI' if (magic == 0x1234) else '<8sIIIIIIIII'   # v2 has 32 bit reloc/line counts
+    pos = 20 + opthdr
+    segments = []
+    for i in range(nscns):
+        name, paddr, vaddr, size, scnptr, relptr, lnnoptr, nreloc, nlnno, flags = struct.unpack_from(sh, data, pos)
+        pos += struct.calcsize(sh)
+        if ((flags & 0x120) and (scnptr > 0) and (size > 0)):      # STYP_TEXT, STYP_DATA_ROM
+            segments.append((paddr, mv[scnptr:scnptr + size]))
+    return segments
 
 ###################################################################
-def read_registry_names():
+# Yield (address, word) for every word of `region` with at least one
+# programmed byte, in address order
+#
+def region_words(region):
+    data = region.data
+    present = region.present
+    pos = 0
+    while True:
+        i = present.find(1, pos)            # start of a run of programmed bytes
+        if (i < 0):
+            break
+        j = present.find(0, i)              # end of this run
+        if (j < 0):
+            j = len(present)
+        i &= ~1
+        j = (j + 1) & ~1
+        words = array('H', bytes(data[i:j]))
+        if (sys.byteorder == 'big'):
+            words.byteswap()
+        addr = region.base + i
+        for w in words:
+            yield addr, w
+            addr += 2
+        pos = j
+
+###################################################################
+# Write the strings of `lines` to the file object `otf`, joined into
+# chunks of about `size` characters
+#
+def write_chunks(otf, lines, size=1 << 16):
+    buf = []
+    n = 0
+    for txt in lines:
+        buf.append(txt)
+        n += len(txt)
+        if (n >= size):
+            otf.write(''.join(buf))
+            buf = []
+            n = 0
+    if (buf):
+        otf.write(''.join(buf))
+
+###################################################################
+# Write `output_file` with write(otf), '-' = stdout. A regular file (or
+# a new one) is written as output_file.tmp and renamed over it once
+# complete, so an error leaves the previous output as it was. Anything
+# else (a device, a fifo, a symlink) is written in place, like stdout.
+# If write returns False nothing was written and the file is left alone
+# (not for stdout or in place). Returns True if written
+#
+def is_regular_output(output_file):     # written as a tmp file renamed over it
+    return ((output_file != '-') and not os.path.islink(output_file) and
+            ((not os.path.exists(output_file)) or os.path.isfile(output_file)))
+
+def write_output(output_file, write):
+    if (output_file == '-'):
+        done = (write(sys.stdout) is not False)
+        sys.stdout.flush()
+        return done
+    if (not is_regular_output(output_file)):
+        otf = open(output_file, "w")
+        try:
+            return (write(otf) is not False)
+        finally:
+            otf.close()
+    tmp = output_file + '.tmp'
+    otf = open(tmp, "w")
+    try:
+        done = (write(otf) is not False)
+        otf.close()
+        if (done):
+            if (os.path.exists(output_file)):     # keep the mode and owner of the old file
+                st = os.stat(output_file)
+                os.chmod(tmp, st.st_mode & 0o7777)
+                try:
+                    os.chown(tmp, st.st_uid, st.st_gid)
+                except OSError:             # not allowed, the owner is then ours
+                    pass
+            os.replace(tmp, output_file)
+    finally:
+        otf.close()
+        if (os.path.exists(tmp)):
+            os.remove(tmp)
+    return done
+
+###################################################################
+def output_name(output_file):           # output file name for messages
+    return '<stdout>' if (output_file == '-') else os.path.abspath(output_file)
+
+###################################################################
+# Return the indexes where the byte sequences `a` and `b` differ,
+# all the extra tail of the longer one included
+#
+def diff_indexes(a, b):
+    n = min(len(a), len(b))
+    out = []
+    step = 4096
+    for i in range(0, n, step):
+        if (a[i:i + step] != b[i:i + step]):
+            for j in range(i, min(i + step, n)):
+                if (a[j] != b[j]):
+                    out.append(j)
+    out.extend(range(n, max(len(a), len(b))))
+    return out
+
+###################################################################
+def read_registry_names(path=regnames_file):
     # Provide symbolic names for all special file registers
-    f = open('regnames18.txt', "r");
+    f = open(path, "r");
     regn = {}
     rn = f.readlines()
     for x in rn:
@@ -207,10 +708,9 @@ def read_registry_names():
     return regn
 
 ###################################################################
-def read_conf_regs():
-    global conf_regs
+def read_conf_regs(path=confregs_file):
     # Provide symbolic names for all config words
-    f = open('confregs18.txt', "r");
+    f = open(path, "r");
     conf_regs = {}
     rn = f.readlines()
 
@@ -221,6 +721,132 @@ def read_conf_regs():
         a, b = x.split(' ')
         conf_regs[int(a, 16)] = b
     f.close()
+    return conf_regs
+
+###################################################################
+# Return `name` if it exists, else the file of that name in `data_dir`
+#
+def data_path(name):
+    if (os.path.isabs(name) or os.path.exists(name)):
+        return name
+    return os.path.join(data_dir, name)
+
+def device_key(name):                   # 'PIC18F47Q10', '18f47q10' -> '18F47Q10'
+    name = name.upper()
+    return name[3:] if (name.startswith('PIC')) else name
+
+###################################################################
+# Device database. The source `devices_file` lists one part per line
+# with its memory ranges and name files (see devices18.txt). It is
+# compiled once into `cache_dir`/devices-<hash of the list>.db:
+#   b'PICDEV18', index size (uint32 le), pickled index, device records
+# The index gives key=device, value=(offset, size, hash of its sources)
+# and each record is a pickled dict of the device tables, so only the
+# selected one is unpickled from the mapped file. A device whose name
+# files changed has another hash, the database is then compiled again.
+#
+def read_device_list(path=devices_file):
+    # Return key=device, value=(name, flash, eeprom, name files, line)
+    path = data_path(path)
+    f = open(path, "r")
+    text = f.read()
+    f.close()
+    folder = os.path.dirname(path)
+    devices = {}
+    for x in text.splitlines():
+        fields = x.split()
+        if ((not fields) or fields[0].startswith(';')):
+            continue
+        if (len(fields) != 5):
+            raise ValueError('Bad device line: %s' % x)
+        ranges = []
+        for r in fields[1:3]:
+            start, stop = r.split('-')
+            ranges.append((int(start, 16), int(stop, 16)))
+        files = [os.path.join(folder, name) for name in fields[3:]]
+        devices[device_key(fields[0])] = (fields[0], ranges[0], ranges[1], files, x.strip())
+    return devices, hashlib.sha1(text.encode()).hexdigest()
+
+def device_digest(spec):
+    h = hashlib.sha1(spec[4].encode())
+    for path in spec[3]:
+        f = open(path, "rb")
+        h.update(f.read())
+        f.close()
+    return h.hexdigest()
+
+def make_device_entry(spec):
+    name, flash, eeprom, files, line = spec
+    return {'name': name, 'flash': flash, 'eeprom': eeprom,
+            'reg_names': read_registry_names(files[0]), 'conf_regs': read_conf_regs(files[1]),
+            'digest': device_digest(spec)}
+
+def compile_devices(devices, path):
+    index = {}
+    records = []
+    offset = 0
+    for key in sorted(devices):
+        rec = pickle.dumps(make_device_entry(devices[key]), pickle.HIGHEST_PROTOCOL)
+        index[key] = (offset, len(rec), device_digest(devices[key]))
+        records.append(rec)
+        offset += len(rec)
+    head = pickle.dumps(index, pickle.HIGHEST_PROTOCOL)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.%d' % (path, os.getpid())
+    f = open(tmp, "wb")
+    f.write(b'PICDEV18' + struct.pack('<I', len(head)) + head)
+    for rec in records:
+        f.write(rec)
+    f.close()
+    os.replace(tmp, path)
+
+# Return the device record `key` of the compiled database `path`,
+# None if missing or compiled from other sources
+def read_device_db(path, key, digest):
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return None
+    try:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):       # empty file
+        f.close()
+        return None
+    try:
+        if (m[:8] != b'PICDEV18'):
+            return None
+        size = struct.unpack_from('<I', m, 8)[0]
+        index = pickle.loads(m[12:12 + size])
+        if ((key not in index) or (index[key][2] != digest)):
+            return None
+        offset, length, digest = index[key]
+        return pickle.loads(m[12 + size + offset:12 + size + offset + length])
+    finally:
+        m.close()
+        f.close()
+
+###################################################################
+# Return the Device `name` (eg. 18F47Q10 or PIC18F47Q10), from the
+# compiled device database, which is built first if needed
+#
+def load_device(name=default_device, path=devices_file):
+    devices, list_digest = read_device_list(path)
+    key = device_key(name)
+    if (key not in devices):
+        raise ValueError('Unknown device %s, known devices: %s' % (name, ' '.join(sorted(devices))))
+    digest = device_digest(devices[key])
+    db = os.path.join(cache_dir, 'devices-%s.db' % list_digest)
+    try:
+        entry = read_device_db(db, key, digest)
+    except (pickle.UnpicklingError, EOFError, struct.error, ValueError):
+        entry = None
+    if (entry is None):
+        try:                            # cache is optional, ignore read-only locations
+            compile_devices(devices, db)
+        except OSError:
+            pass
+        entry = make_device_entry(devices[key])
+    return Device(entry)
 
 ###################################################################
 # Read a specially-formatted string to build the opcode-identification table.
@@ -240,8 +866,8 @@ def read_conf_regs():
 # see the `matching_opcode` and `assembly_string` functions for the
 # examples of the use of this table
 #
-def make_operand_table():
-    f = open('opcodes18.txt', "r");
+def make_operand_table(path=opcodes_file):
+    f = open(path, "r");
     oplist = []
     opcode_templates = f.readlines()
     for x in opcode_templates:#.split('\n'):
@@ -268,6 +894,7 @@ def make_operand_table():
         opc.mask = cm             # Eg: 0xfc00
         opc.skip = (skip != '0')  # Eg: False
         opc.stop = (stop != '0')  # Eg: False
+        compile_template(opc)
 
         oplist.append(opc)
 
@@ -275,31 +902,167 @@ def make_operand_table():
     return oplist
 
 ###################################################################
-# Return the assembly-language template string
-# that matches a given binary instruction word
+# Build the dense decode table: one byte per possible instruction word,
+# holding the index of the first `oplist` entry that matches the word
+# (0xFF if none does). Entries are filled in list order, so the first-match
+# priority of the opcode file is kept.
 #
-def matching_opcode(w):
-    global operand_table
+def make_decode_table(oplist):
+    table = bytearray(b'\xff' * 0x10000)
+    for i, opc in enumerate(oplist):
+        free = ~opc.mask & 0xFFFF
+        sub = 0
+        while True:                       # enumerate every don't-care bit combination
+            w = opc.value | sub
+            if (table[w] == 0xFF):
+                table[w] = i
+            sub = (sub - free) & free
+            if (sub == 0):
+                break
+    return bytes(table)
 
-    for opc in operand_table:
-        if ((w & opc.mask) == opc.value):
-            return opc
-    return Opcode()                         # return dummy opcode 'X' unidentifiable binary -- punt
+###################################################################
+# Return the decode table for `oplist`, built from the opcode file `path`.
+# The table is cached on disk, keyed by a hash of the opcode file,
+# so it is only rebuilt when the file changes.
+#
+def load_decode_table(oplist, path=opcodes_file):
+    try:
+        f = open(path, "rb")
+        digest = hashlib.sha1(f.read()).hexdigest()
+        f.close()
+    except OSError:
+        return make_decode_table(oplist)
+    path = os.path.join(cache_dir, 'decode-%s.bin' % digest)
+    try:
+        f = open(path, "rb")
+        table = f.read()
+        f.close()
+        if (len(table) == 0x10000):
+            return table
+    except OSError:
+        pass
+    table = make_decode_table(oplist)
+    try:                                  # cache is optional, ignore read-only locations
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = '%s.%d' % (path, os.getpid())
+        f = open(tmp, "wb")
+        f.write(table)
+        f.close()
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    return table
+
+###################################################################
+# Result cache. Rendered .asm files are stored in `result_cache_dir`
+# under a key made of the hex file contents and every option changing
+# the output (see `Disassembler.cache_key`). A hit refreshes the file
+# time, the least recently used files are evicted once the cache grows
+# above `result_cache_size` bytes.
+#
+def result_cache_get(key, otf):
+    path = os.path.join(result_cache_dir, key + '.asm')
+    try:
+        f = open(path, "r")
+        os.utime(path)
+    except OSError:                       # not cached, or evicted meanwhile
+        return False
+    shutil.copyfileobj(f, otf, 1 << 16)
+    f.close()
+    return True
+
+def result_cache_put(key, output_file):
+    path = os.path.join(result_cache_dir, key + '.asm')
+    try:                                  # cache is optional, ignore read-only locations
+        os.makedirs(result_cache_dir, exist_ok=True)
+        tmp = '%s.%d.%d' % (path, os.getpid(), threading.get_ident())
+        shutil.copyfile(output_file, tmp)
+        os.replace(tmp, path)
+        result_cache_evict()
+    except OSError:
+        pass
+
+def result_cache_evict():
+    entries = []
+    for e in os.scandir(result_cache_dir):
+        if (e.name.endswith('.asm')):
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, e.path))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):     # oldest first
+        if (total <= result_cache_size):
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
 
 ###################################################################
-def lookup_adr(addr):
-    global code
-    if (addr in code):
-        return code[addr]
-    else:                            # exceptional case: a jump to a location not defined in hexfile
-        x = Instruction()            #                    or a missing second word in a dword instr
-        x.dummy = 1
-        x.bin = 0xffff
-        x.bytes = 2
-        code[addr] = x
-        return x
+# Operand fields, each one returns the text of one template operand.
+# d is the Disassembler, w2 is the second word of dword instructions (0 otherwise)
+#
+def field_f(d, addr, w, w2):        # banked register-file address
+    return d.hexc(w & 0xFF)
+
+def field_f_access(d, addr, w, w2): # access bank, SFR name if above 0x80
+    q = w & 0xFF
+    if (q >= 0x80):
+        return d.reg_names.get(q | 0xF00, d.hexc(q))
+    return d.hexc(q)
+
+def field_b(d, addr, w, w2):        # bit-number
+    return '%d' % ((w >> 9) & 0x7)
+
+def field_k(d, addr, w, w2):        # 8-bit constant
+    return d.hexc(w & 0xFF)
+
+def field_c(d, addr, w, w2):        # movlb
+    return d.hexc(w & 0xF)
+
+def target_n(addr, w, w2):          # branch relative +- 127
+    q = w & 0xFF
+    if (q < 0x80):
+        return addr + 2 + (q * 2)
+    return addr + 2 - (0x100 - q) * 2
+
+def target_m(addr, w, w2):          # rcall/bra relative +- 1023
+    q = w & 0x7FF
+    if (q < 0x400):
+        return addr + 2 + (q * 2)
+    return addr + 2 - ((0x800 - q) * 2)
+
+def target_w(addr, w, w2):          # call/goto absolute
+    return ((w & 0xFF) | ((w2 & 0xFFF) << 8)) * 2
+
+def field_n(d, addr, w, w2):
+    return makelabel(target_n(addr, w, w2))
+
+def field_m(d, addr, w, w2):
+    return makelabel(target_m(addr, w, w2))
+
+def field_w(d, addr, w, w2):
+    return makelabel(target_w(addr, w, w2))
+
+def field_y(d, addr, w, w2):        # movff
+    return d.reg_names.get(w & 0xFFF, d.hexc(w & 0xFFF)) + ',' + d.reg_names.get(w2 & 0xFFF, d.hexc(w2 & 0xFFF))
+
+def field_z(d, addr, w, w2):        # lfsr
+    return str((w & 0x30) >> 4) + ',' + d.hexc(((w & 0xF) << 8) | (w2 & 0xFF))
+
+def field_x(d, addr, w, w2):        # the hex version of the whole word
+    return 'DW ' + d.hexc(w) + '\t\t;WARNING: unknown instruction!'
 
 ###################################################################
+# Compile the template of `opc` into formatters.
+# The template characters are interpreted once for every combination of the
+# a, d, s bits the template depends on, which gives a format string and the
+# list of fields to fill in. Rendering a word is then a single `%` operation.
+#
 # F        .... .... ffff ffff
 # N        .... .... nnnn nnnn
 # M        .... .nnn nnnn nnnn
@@ -312,276 +1075,84 @@ def lookup_adr(addr):
 # W        double  -call,goto
 # Y        double  -movff
 # Z        double  -lfsr
-def assembly_line(addr):
-    global code, stack, bank
-
-    cod = code[addr]
-    w = cod.bin
-    opc = matching_opcode(w)       # get the right assembly template
+def compile_template(opc):
     t = opc.template
-    #print (t)
-    af = w & 0x100
-    code[addr].bytes = 2          # 2 bytes by default
-    code[addr].stop = opc.stop    # stop coverage analyze after goto, return, branch
-    if (opc.skip):
-        sti = StackItem()
-        sti.addr = addr + 4
-        sti.bank = bank
-        stack.append(sti)
-    if (debug):
-        print(hexc(w), t)
-    s = []                        # init the return value
-    for c in t:                   # for each character in the template
-        if (c == 'F'):            # insert a register-file address
-            q = w & 0xFF
-            if (af != 0):         # banked, calculate and search for SFR name, add it to comment if found
-                reg_name = reg_names.get(q | (bank << 8), '')
-                if (reg_name):
-                    code[addr].comment += ' ' + reg_name
-            if ((af == 0) and (q >= 0x80)):
-                s.append(reg_names.get(q | 0xF00, hexc(q)))
-            else:
-                s.append(hexc(q))
-        elif (c == 'D'):            # insert a ",w" modifier = 0, if appropriate
-            if ((w & 0x200) == 0):
-                s.append('W')
-            else:
-                s.append('f')
-        elif (c == 'B'):            # insert a bit-number
-            s.append('%d' % (((w >> 9) & 0x7)))
-        elif (c == 'K'):            # insert an 8-bit constant
-            s.append(hexc(w & 0xFF))
-        elif (c == 'C'):            # movlb
-            s.append(hexc(w & 0xF))
-        elif (c == 'N'):            # branch relative +- 127
-            q = (w & 0xFF)
-            if (q < 0x80):
-                dest = addr + 2 + (q * 2)
-            else:
-                dest = addr + 2 - (0x100 - q) * 2
-            s.append(makelabel(dest))
-            sti = StackItem()
-            sti.addr = dest
-            sti.bank = bank
-            stack.append(sti)
-            lookup_adr(dest).calls.append(addr)
-        elif (c == 'M'):            # insert a rcall/bra relative +- 1023
-            q = w & 0x7FF
-            if q < 0x400:
-                dest = addr + 2 + (q * 2)
-            else:
-                dest = addr + 2 - ((0x800 - q) * 2)
-            s.append(makelabel(dest))
-            sti = StackItem()
-            sti.addr = dest
-            sti.bank = bank
-            stack.append(sti)
-            lookup_adr(dest).calls.append(addr)
-        elif (c == 'A'):            # access bank = 0 implicit
-            if ((w & 0x100) != 0):
-                s.append('b') # 'BANKED'
-            elif s[-3:] == [',', 'f', ',']:# do not show:    ,f,0
-                s = s[:-3]
-            elif s[-1] == ',':    # do not show:    ,0
-                del s[-1]
-            if ((w & 0x100) == 0):
-                s.append(',a') # ',ACCESS'
-        elif (c == 'S'):            # =1 restore reg. on ret: retfie/return (implicit 0)
-            if (w & 0x1) == 1:
-                s.append('FAST')
-            elif s[-1] == ',':
-                del s[-1]
-        elif (c == 'Y'):            # dword    movff
-            w2 = lookup_adr(addr + 2).bin
-            s.append(reg_names.get(w  & 0xFFF, hexc(w  & 0xFFF)) + ',' +
-                     reg_names.get(w2 & 0xFFF, hexc(w2 & 0xFFF)))
-            code[addr].bytes = 4
-        elif (c == 'W'):            # dword    call/goto
-            w2 = lookup_adr(addr + 2).bin
-            dest = ((w & 0xFF) | ((w2 & 0xFFF) << 8)) * 2
-            lookup_adr(dest).calls.append(addr)
-            s.append(makelabel(dest))
-            sti = StackItem()
-            sti.addr = dest
-            sti.bank = bank
-            stack.append(sti)
-            code[addr].bytes = 4
-            if ((w & 0x300) ^ 0x100) == 0:    # only if its a 'call' and 's' is set
-                s.append(',FAST')
-        elif (c == 'Z'):            # dword    lfsr
-            w2 = lookup_adr(addr + 2).bin
-            s.append(str((w & 0x30) >> 4) + ',' + hexc(((w & 0xF) << 8) | (w2 & 0xFF)))
-            code[addr].bytes = 4
-        elif (c == 'X'):            # insert the hex version of the whole word
-            s.append('DW ' + hexc(w) + '\t\t;WARNING: unknown instruction!')
-        else:                    # insert this source-code character
-            if (c == ' '):
+    fields = {'B': field_b, 'K': field_k, 'C': field_c, 'N': field_n, 'M': field_m,
+              'W': field_w, 'Y': field_y, 'Z': field_z, 'X': field_x}
+    mask = 0
+    if ('F' in t) or ('A' in t):
+        mask |= 0x100
+    if ('D' in t):
+        mask |= 0x200
+    if ('S' in t):
+        mask |= 0x1
+    if ('W' in t):
+        mask |= 0x300
+    opc.variant_mask = mask
+    opc.banked = ('F' in t)
+    opc.bytes = 4 if (('W' in t) or ('Y' in t) or ('Z' in t)) else 2
+    opc.target = {'N': target_n, 'M': target_m, 'W': target_w}.get(next((c for c in t if c in 'NMW'), ''))
+    opc.call = (t.split(' ')[0] in ('call', 'rcall'))
+    opc.formats = {}
+
+    v = 0
+    while True:                             # for each combination of the variant bits
+        s = []                              # str = literal text, otherwise a field
+        for c in t:
+            if (c == 'F'):
+                s.append(field_f if (v & 0x100) else field_f_access)
+            elif (c == 'D'):                # insert a ",w" modifier = 0, if appropriate
+                s.append('W' if ((v & 0x200) == 0) else 'f')
+            elif (c == 'A'):                # access bank = 0 implicit
+                if ((v & 0x100) != 0):
+                    s.append('b') # 'BANKED'
+                elif s[-3:] == [',', 'f', ',']:# do not show:    ,f,0
+                    s = s[:-3]
+                elif s[-1] == ',':    # do not show:    ,0
+                    del s[-1]
+                if ((v & 0x100) == 0):
+                    s.append(',a') # ',ACCESS'
+            elif (c == 'S'):                # =1 restore reg. on ret: retfie/return (implicit 0)
+                if (v & 0x1) == 1:
+                    s.append('FAST')
+                elif s[-1] == ',':
+                    del s[-1]
+            elif (c in fields):
+                s.append(fields[c])
+                if (c == 'W') and (((v & 0x300) ^ 0x100) == 0):    # only if its a 'call' and 's' is set
+                    s.append(',FAST')
+            elif (c == ' '):
                 while (len(s) < 7):
-                   s.append(' ')
-            else:
+                    s.append(' ')
+            else:                           # insert this source-code character
                 s.append(c)
 
-    # tracking bank
-    if (t == 'movlb C'):
-        bank = w & 0xF
-
-    code[addr].asm = ''.join(s)
-    #print(code[addr].asm)
+        fmt = ''.join(('%s' if callable(x) else x.replace('%', '%%')) for x in s)
+        opc.formats[v] = (fmt, [x for x in s if callable(x)])
 
-###############################################################
-def eep_cfg_txt():                    # generate text for the eeprom and configuration words
-    txt = ''
-    for x in configuration:
-        if listing:
-            txt += '%06X %04X' % (int(x), int(configuration[x]))
-            txt += '\tCONFIG %s = %s\n' % ((conf_regs[x] if (x in conf_regs) else hexc(x)), hexc(configuration[x]))
-        else:
-            txt += '\t\tCONFIG %s = %s\n' % ((conf_regs[x] if (x in conf_regs) else hexc(x)), hexc(configuration[x]))
-    if eeprom:
-        txt += '\t\t;eeprom:\n'
-        for x in eeprom:            # hopefully the hex will have very fey eeprom location defined
-            if listing:
-                txt += '%06X %04X\n' % (x, eeprom[x].bin)
-            else:
-                txt += '\t\tORG %s\n\t\tdw %s\n' % (hexc(x), hexc(eeprom[x].bin))
-    if txt:
-        txt += '\n\n'
-    return txt
+        v = (v - mask) & mask
+        if (v == 0):
+            break
 
-###############################################################
-def analyze_coverage():
+###################################################################
+# Render the instruction word(s) with the compiled template of `opc`
+#
+def render_opcode(d, opc, addr, w, w2):
+    fmt, fields = opc.formats[w & opc.variant_mask]
+    if (not fields):
+        return fmt
+    return fmt % tuple([f(d, addr, w, w2) for f in fields])
 
-    global code, covered, stack, bank
-
-    while (len(stack) > 0):
-        #print ('stack len %d' % len(stack))
-        sti = stack.pop()
-        addr = sti.addr;
-        bank = sti.bank;
-        #print (addr)
-        if (addr in covered):
-            continue
-        stop = False
-        while (not stop):
-            covered[addr] = True
-            if (addr in code):
-                #print ('addr in code')
-                assembly_line(addr)
-                stop = code[addr].stop
-                addr += code[addr].bytes
-            else: # word is not programmed read as 0xffff (nil)
-                #print ('addr not in code')
-                addr += 2
-            addr = addr & 0xfffff # 20 bit address space
-            stop = stop or (addr in covered) # stop if address is already covered
+unknown_opcode = Opcode()                   # dummy opcode 'X' unidentifiable binary
+compile_template(unknown_opcode)
 
 ###############################################################
 def is_movwf_tblptrx(bin):
     return (bin == 0x6EF6) or (bin == 0x6EF7) or (bin == 0x6EF8)
 
 ###############################################################
-def is_code(addr):
-    #global code, covered
-    return (addr in code) and (addr in covered)
-
-###############################################################
-def analyze_table_pointers():
-    addr_tblptrl = 0
-    addr_tblptrh = 0
-    addr_tblptru = 0
-
-    addr = max_addr
-
-    #print("max_addr = %s" % max_addr)
-
-    while (addr >= 0):
-        if (is_code(addr)):
-
-            if (is_movwf_tblptrx(code[addr].bin)):
-
-                # backward serach for tblptr loading opcodes
-                paddr = addr
-
-                l_found = False
-                h_found = False
-                u_found = False
-
-                l_op_addr = 0
-                h_op_addr = 0
-                u_op_addr = 0
-
-                while (paddr >= 0) and (paddr > (addr - 100)) and (is_code(paddr)) and ((not l_found) or (not h_found) or (not u_found)):
-
-                    if (not l_found and (code[paddr].bin == 0x6EF6)): #tblptrl
-                        addr_tblptrl = paddr;
-                        code[paddr].comment += ' tblptrl '
-                        laddr = paddr - 2
-                        while ((laddr >= 0) and (laddr > (paddr - 20)) and is_code(laddr) and not is_movwf_tblptrx(code[laddr].bin)):
-                            if ((code[laddr].bin == 0x0F01) and is_code(laddr - 2) and (code[laddr - 2].bin == 0xB0D8)):
-                                laddr = laddr - 4
-                                continue
-                            if ((code[laddr].bin & 0xfe00) == 0x0e00):
-                                code[laddr].comment += ' L ADDR '
-                                l_op_addr = laddr
-                                l_found = True
-                                break
-                            laddr = laddr - 2
-
-                    if (not h_found and (code[paddr].bin == 0x6EF7)): #tblptrh
-                        addr_tblptrh = paddr;
-                        code[paddr].comment += ' tblptrh '
-                        laddr = paddr - 2
-                        while ((laddr >= 0) and (laddr > (paddr - 20)) and is_code(laddr) and not is_movwf_tblptrx(code[laddr].bin)):
-                            if ((code[laddr].bin == 0x0F01) and is_code(laddr - 2) and (code[laddr - 2].bin == 0xB0D8)):
-                                laddr = laddr - 4
-                                continue
-                            if ((code[laddr].bin & 0xfe00) == 0x0e00):
-                                code[laddr].comment += ' H ADDR '
-                                h_op_addr = laddr
-                                h_found = True
-                                break
-                            laddr = laddr - 2
-
-                    if (not u_found and (code[paddr].bin == 0x6EF8)): #tblptru
-                        addr_tblptru = paddr;
-                        code[paddr].comment += ' tblptru '
-                        laddr = paddr - 2
-                        while ((laddr >= 0) and (laddr > (paddr - 20)) and is_code(laddr) and not is_movwf_tblptrx(code[laddr].bin)):
-                            if ((code[laddr].bin == 0x0F01) and is_code(laddr - 2) and (code[laddr - 2].bin == 0xB0D8)):
-                                laddr = laddr - 4
-                                continue
-                            if ((code[laddr].bin & 0xfe00) == 0x0e00):
-                                code[laddr].comment += ' U ADDR '
-                                u_op_addr = laddr
-                                u_found = True
-                                break
-                            laddr = laddr - 2
-
-                    paddr = paddr - 2
-
-                if (l_found and h_found and u_found):
-
-                    # calculate table address
-                    table_addr = ((code[u_op_addr].bin & 0xff) << 16) | ((code[h_op_addr].bin & 0xff) << 8) | (code[l_op_addr].bin & 0xff)
-
-                    if (table_addr not in code):
-                        print("Invalid table address found!!! %s" % table_addr)
-                        code[u_op_addr].comment += ' INVALID !!!'
-                        code[h_op_addr].comment += ' INVALID !!!'
-                        code[l_op_addr].comment += ' INVALID !!!'
-                    else:
-                        # add label to table
-                        code[table_addr].label = maketablelabel(table_addr)
-                        #print("Table label added %s" % code[table_addr].label)
-
-                        # replace pointer loading opcodes with (low LABEL, high LABEL, upper LABEL)
-                        code[u_op_addr].asm = ('movlw' if ((code[u_op_addr].bin & 0xff00) == 0x0e00) else 'addlw') + '  low highword ' + maketablelabel(table_addr)
-                        code[h_op_addr].asm = ('movlw' if ((code[h_op_addr].bin & 0xff00) == 0x0e00) else 'addlw') + '  high ' + maketablelabel(table_addr)
-                        code[l_op_addr].asm = ('movlw' if ((code[l_op_addr].bin & 0xff00) == 0x0e00) else 'addlw') + '  low ' + maketablelabel(table_addr)
-
-                    addr = min(addr_tblptrl, addr_tblptrh, addr_tblptru)
-
-        addr = addr - 2
+def is_movlb(bin):
+    return (bin & 0xFFF0) == 0x0100
 
 ###############################################################
 def ascii_char(code):
@@ -595,8 +1166,10 @@ def fix_line_wrap(s):
     return (s if (not s or (s[-1] != '\\')) else s + '.')
 
 ###############################################################
+# Read a db definitions file, returns a list of TableDef's
+#
 def read_table_defs(file):
-    global table_defs
+    table_defs = []
 
     tmp_table_def = TableDef()
 
@@ -624,89 +1197,2344 @@ def read_table_defs(file):
 
     #for t in table_defs:
     #   print('"%s" %s' % (t.comment, len(t.data)))
+    return table_defs
 
 ###############################################################
-
+# Read a jump-table file, returns a list of (start, stop, kind, name)
+# address ranges. Each line is
+#   start,stop[,kind[,name]]
+# kind 'code' (default): every word of the range is a code entry point
+#   (jump table), 'data': the range is kept as data, the code coverage
+#   does not go into it. A named range gets the name as a comment line.
+#
 def read_jumptable_defs(file):
+    jumptable_defs = []
 
     for s in file.readlines():
-        if (len(s) <= 1):
+        if (len(s.strip()) == 0):
             continue
         if (s[0] == ';'):
             #print("JumpTable comment found = %s" % s[1:])
             continue
-        start, stop = s.split(',')
+        fields = [f.strip() for f in s.split(',', 3)]
+        start, stop = fields[0:2]
+        kind = fields[2].lower() if (len(fields) > 2) else 'code'
+        name = fields[3] if (len(fields) > 3) else ''
         start_addr = int(start, 16)
         stop_addr = int(stop, 16)
         #print('jumptable: ', start, stop)
-        if (start_addr <= stop_addr):
-            while (start_addr <= stop_addr):
-                sti = StackItem()
-                sti.bank = 0
-                sti.addr = start_addr
-                stack.append(sti)
-                start_addr += 2
+        if (kind not in ('code', 'data')):
+            print("Bad syntax, jumptable file: %s,%s unknown kind %s" % (start, stop, kind), file=sys.stderr)
+        elif (start_addr <= stop_addr):
+            jumptable_defs.append((start_addr, stop_addr, kind, name))
         else:
-            print("Bad syntax, jumptable file: %s > %s" % (start, stop))
+            print("Bad syntax, jumptable file: %s > %s" % (start, stop), file=sys.stderr)
 
     file.close()
+    return jumptable_defs
 
 ###############################################################
-def search_table_def_matched():
-
-    global code, covered, table_defs
-
-    waddrs = list(code.keys())
-    waddrs.sort()
-
-    for t in table_defs:
+# Build an Aho-Corasick automaton for a list of byte patterns.
+# Returns (goto, fail, out): goto[state] maps a byte to the next state,
+# fail[state] is the fallback state and out[state] lists the indexes of
+# the patterns ending in that state
+#
+def make_pattern_automaton(patterns):
+    goto = [{}]
+    out = [[]]
+    for k, data in enumerate(patterns):
+        st = 0
+        for b in data:
+            nxt = goto[st].get(b)
+            if (nxt is None):
+                nxt = len(goto)
+                goto.append({})
+                out.append([])
+                goto[st][b] = nxt
+            st = nxt
+        out[st].append(k)
+
+    fail = [0] * len(goto)
+    queue = list(goto[0].values())          # breadth first, depth 1 states fail to the root
+    for st in queue:
+        for b, nxt in goto[st].items():
+            queue.append(nxt)
+            f = fail[st]
+            while (f and (b not in goto[f])):
+                f = fail[f]
+            fail[nxt] = goto[f].get(b, 0)
+            out[nxt] = out[nxt] + out[fail[nxt]]
+    return goto, fail, out
 
-        #print('Sarching for %s' % t.comment)
-        #print('len(t.data) = %s' % len(t.data))
-        #print('max_addr = %s' % max_addr)
+###############################################################
+# Wall time and peak memory of each phase of the pipeline, and the work
+# counters of the passes (--stats). The peak is the resident size of the
+# process so far (getrusage, costs nothing); if tracemalloc was started
+# (PYTHONTRACEMALLOC=1), it is the peak of the Python allocations in the
+# phase instead.
+#
+class Stats:
+    def __init__(self):
+        self.phases = []                # (name, seconds, peak bytes) of the finished phases
+        self.counters = {}              # key=counter name, value=count
+        self.name = None                # the current phase
+        self.t0 = 0
+
+    # End the current phase and start `name` (None = no new phase)
+    def phase(self, name):
+        now = time.perf_counter()
+        if (self.name is not None):
+            self.phases.append((self.name, now - self.t0, self.peak()))
+        if (tracemalloc.is_tracing()):
+            tracemalloc.reset_peak()
+        self.name = name.rstrip('.') if (name) else None
+        self.t0 = now
+
+    # Return the peak memory in bytes, 0 if not known
+    def peak(self):
+        if (tracemalloc.is_tracing()):
+            return tracemalloc.get_traced_memory()[1]
+        if (resource is None):
+            return 0
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if (sys.platform == 'darwin') else (rss << 10)      # bytes on macOS, KB elsewhere
+
+    def add(self, counters):
+        for name, n in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def write(self, otf):
+        otf.write('%-44s %10s %10s\n' % ('phase', 'seconds', 'peak KB'))
+        for name, seconds, peak in self.phases:
+            otf.write('%-44s %10.3f %10d\n' % (name, seconds, peak >> 10))
+        otf.write('%-44s %10.3f %10d\n' % ('total', sum(p[1] for p in self.phases), max([p[2] for p in self.phases] + [0]) >> 10))
+        for name in sorted(self.counters):
+            otf.write('%-44s %10d\n' % (name, self.counters[name]))
+
+    def write_json(self, otf):
+        json.dump({'phases': [{'phase': name, 'seconds': seconds, 'peak_bytes': peak} for name, seconds, peak in self.phases],
+                   'total_seconds': sum(p[1] for p in self.phases), 'counters': self.counters}, otf, indent=1)
+        otf.write('\n')
 
-        byte_addr = 0
+###############################################################
+# The disassembler. Holds the state of one image, the definition tables
+# are shared. Typical use:
+#
+#   d = Disassembler(get_definitions(), hexstyle=1)
+#   d.load_hex(open('file.hex'))
+#   d.analyze()
+#   d.render(open('file_.asm', 'w'))
+#
+# Separate instances can be used concurrently from several threads.
+#
+class Disassembler:
+    def __init__(self, defs=None, hexstyle=0, listing=0, table_defs=(), jumptable_defs=(),
+                 use_interrupt1=False, use_interrupt2=False, verbose=0, use_cache=False, incremental=False,
+                 log=None, base=0, stats=None):
+        self.defs = defs if defs else get_definitions()
+        self.reg_names = self.defs.reg_names
+        self.conf_regs = self.defs.conf_regs
+        self.eeprom_base = self.defs.device.eeprom[0]
+        self.hexstyle = hexstyle        # 0 = 0NNh, 1 = 0xNN - kjc: changed default
+        self.listing = listing          # =1 => only 1 asm line per each addr. ( -empty +nil )
+        self.table_defs = list(table_defs)
+        self.jumptable_defs = []        # (start, stop, kind, name), see `read_jumptable_defs`
+        for d in jumptable_defs:
+            self.jumptable_defs.append(tuple(d) + ('code', '')[len(d) - 2:])
+        self.code_ranges = RangeSet((d[0], d[1]) for d in self.jumptable_defs if (d[2] == 'code'))
+        self.data_ranges = RangeSet((d[0], d[1]) for d in self.jumptable_defs if (d[2] == 'data'))
+        self.use_interrupt1 = use_interrupt1
+        self.use_interrupt2 = use_interrupt2
+        self.base = base                # load address of raw binary images (see `load_bin`)
+        self.verbose = verbose          # =1 => progress messages
+        self.log = log                  # file of the progress messages, None = stdout
+        self.stats = stats              # Stats timing the phases, None = not measured
+        self.use_cache = use_cache      # use the result cache in `disassemble`
+        self.incremental = incremental  # keep what `update` needs to redo only the changed parts
+        self.layers = None              # key=pass, value=what it found in the last analyze, which `update`
+                                        # patches (incremental, see `analyze`)
+        self.lines = None               # key=address, value=text written by the last render (incremental)
+        self.reset()
+
+    def reset(self):
+        self.code = None                # Program, the program memory model
+        self.eeprom = None              # Region, data eeprom (device eeprom start - 0x3effff)
+        self.configuration = {}         # key = config address, value = config byte
+        self.max_addr = 0               # top address loaded by the hex file
+        self.stack = array('q')         # worklist of the code coverage, addresses to walk from
+        self.queued = {}                # key=address in `stack`, value=its index
+        self.entries = []               # entry points of the code coverage, StackItem's with the initial bank
+                                        # (the words of `code_ranges` are entry points too, with bank 0)
+        self.dirty = None               # addresses whose lines `render` can not reuse, set by `update`
+        self.counters = {}              # key=counter name, value=work done by the passes (see `count`)
+        self.xref = None                # XrefIndex of the last analyze, built on first use (see `xrefs`)
+
+    ###################################################################
+    def info(self, *args):              # progress message
+        if (self.verbose):
+            print(*args, file=self.log)
+
+    def phase(self, *args):             # progress message starting a new phase of `stats`
+        if (self.stats):
+            self.stats.phase(args[0])
+        self.info(*args)
+
+    def count(self, name, n):           # add `n` to a work counter
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    ###################################################################
+    def hexc(self, nr):                 #custom hex()
+        if (self.hexstyle):
+            if (nr < 10):
+                return str(int(nr))
+            return '0x%X' % int(nr)    # C syle
+        else:
+            if (nr < 10):
+                return str(int(nr))    # ASM style
+            t = '%Xh' % int(nr)
+            if (t[0] in string.ascii_letters):
+                t = '0' + t
+            return t
+
+    ## kjc: custom hex v2
+    def hexc2(self, nr):
+        if (self.hexstyle):
+            if (nr < 10):
+                return str(int(nr))
+            return '0x%02X' % int(nr)    # C syle
+        else:
+            t = '%Xh' % int(nr)
+            if (t[0] in string.ascii_letters):
+                t = '0' + t
+            return t
+
+    ###################################################################
+    # Reads an Intel HEX file into the `code` program model,
+    # the `eeprom` region and the `configuration` bytes
+    #
+    def load_hex(self, objectfile):
+        self.reset()
+        exta = 0                               # extended linear address
+        records = []
+        for x in objectfile:
+            if debug:
+                print(x[:-1])
+            if x[0] == ':':                    # Intel form        :CCAAAATTllhhllhh....rr
+                x = x.strip()
+                try:
+                    rec = bytes.fromhex(x[1:])
+                except ValueError:
+                    raise ValueError('Bad hex record: %s' % x)
+                nb = rec[0]                    # number of bytes this record
+                if (len(rec) != nb + 5):
+                    raise ValueError('Bad hex record length: %s' % x)
+                if (sum(rec) & 0xFF != 0):     # verify the checksum
+                    raise ValueError((self.hexc(-sum(rec[:-1]) & 0xFF), self.hexc(rec[-1])))
+                ad = exta | (rec[1] << 8) | rec[2]    # starting address this record + extended linear
+                ty = rec[3]                    # record type
+                if ty == 0:
+                    pass
+                elif ty == 1:
+                    break                       # end of record
+                elif ty == 4:                   # extended linear, only :02000004aaaa  supported
+                    exta = ((rec[4] << 8) | rec[5]) << 16
+                    continue
+                else:
+                    self.info("Not a data record")
+                    continue                    # not a data record - ignore it
+                dd = rec[4:-1]                  # isolate the data
+                records.append((ad, dd))
+            else:
+                self.info("Ignoring line: ", x)                    # ignore anything else
+
+        self.load_segments(records)
+
+    ###################################################################
+    # Load the program memory, eeprom and configuration bytes from the
+    # (address, bytes) segments of an object file, each placed by its
+    # start address
+    #
+    def load_segments(self, segments):
+        code_records = []
+        eeprom_records = []
+        for ad, dd in segments:
+            if (ad < 0x300000):
+                code_records.append((ad, dd))
+            elif ((ad >= self.eeprom_base) and (ad < 0x3f0000)):
+                eeprom_records.append((ad, dd))
+            else:
+                for i in range(len(dd)):
+                    if ((ad + i) in self.conf_regs):
+                        self.configuration[ad + i] = dd[i]
+
+        self.code = Program(make_region(0, code_records))
+        self.eeprom = make_region(self.eeprom_base, eeprom_records)
+        self.max_addr = self.code.present.rfind(1) * 2
+        self.check_flash()
+
+    def check_flash(self):
+        flash = self.defs.device.flash
+        if (self.max_addr > flash[1]):
+            self.info('Code above the %s flash memory (%s)' % (self.defs.device.name, self.hexc(flash[1])))
+
+    ###################################################################
+    # Load a raw program memory image (eg. a flash dump) starting at
+    # `base`, every byte is programmed. From address 0 the words are used
+    # in place, a mapped file is not copied
+    #
+    def load_bin(self, data, base=0):
+        self.reset()
+        if ((base == 0) and ((len(data) & 1) == 0) and (len(data) <= 0x300000)):
+            region = Region(0, 0)
+            region.data = memoryview(data)
+            region.present = b'\x01' * len(data)
+            self.code = Program(region)
+            self.eeprom = make_region(self.eeprom_base, [])
+            self.max_addr = self.code.present.rfind(1) * 2
+            self.check_flash()
+        else:
+            self.load_segments([(base, memoryview(data))])
+
+    def load_elf(self, data):
+        self.reset()
+        self.load_segments(elf_segments(data))
+
+    def load_coff(self, data):
+        self.reset()
+        self.load_segments(coff_segments(data))
+
+    ###################################################################
+    # Load the object file contents `data` (bytes or a mapped file) in
+    # the format given by `input_format`
+    #
+    def load(self, data, name=''):
+        fmt = input_format(data, name)
+        if (fmt == 'bin'):
+            self.load_bin(data, self.base)
+        elif (fmt == 'elf'):
+            self.load_elf(data)
+        elif (fmt == 'coff'):
+            self.load_coff(data)
+        else:
+            self.load_hex(str(data, 'latin-1').splitlines(True))
+
+    ###################################################################
+    # Decode the instruction at `addr`, returns (opcode, word, second word).
+    # Only reads the program words, unprogrammed words and dummies read
+    # as 0xffff. Opcodes come from the decode table, the destinations of
+    # branches are computed once by `analyze_coverage` (code.dest)
+    #
+    def decode(self, addr):
+        w = self.code.word_at(addr)
+        opc = self.defs.matching_opcode(w)
+        return opc, w, (self.code.word_at(addr + 2) if (opc.bytes == 4) else 0)
+
+    ###################################################################
+    # Return the assembly text of the decoded instruction at `addr`
+    #
+    def render_line(self, addr):
+        if (addr in self.code.asm):
+            return self.code.asm[addr]
+        opc, w, w2 = self.decode(addr)
+        return render_opcode(self, opc, addr, w, w2)
+
+    ###############################################################
+    # Labels of the branch/call destinations outside of the image
+    #
+    def external_lines(self):
+        targets = sorted(dest for dest in self.code.external if (dest >= 0))
+        if (targets):
+            yield ';branch/call destinations outside of the image:\n'
+            for dest in targets:
+                yield '%s EQU %s\n' % (makelabel(dest), self.hexc(dest))
+            yield '\n'
+
+    ###############################################################
+    def eep_cfg_lines(self):              # generate lines for the eeprom and configuration words
+        hexc = self.hexc
+        empty = True
+        for x in self.configuration:
+            if self.listing:
+                yield '%06X %04X' % (int(x), int(self.configuration[x]))
+                yield '\tCONFIG %s = %s\n' % ((self.conf_regs[x] if (x in self.conf_regs) else hexc(x)), hexc(self.configuration[x]))
+            else:
+                yield '\t\tCONFIG %s = %s\n' % ((self.conf_regs[x] if (x in self.conf_regs) else hexc(x)), hexc(self.configuration[x]))
+            empty = False
+        if self.eeprom and (1 in self.eeprom.present):
+            yield '\t\t;eeprom:\n'
+            for x, w in region_words(self.eeprom):   # hopefully the hex will have very fey eeprom location defined
+                if self.listing:
+                    yield '%06X %04X\n' % (x, w)
+                else:
+                    yield '\t\tORG %s\n\t\tdw %s\n' % (hexc(x), hexc(w))
+            empty = False
+        if (not empty):
+            yield '\n\n'
+
+    ###############################################################
+    # Add `addr` to the code coverage worklist, unless it is covered.
+    # An address already waiting is moved to the top (the pop order of a
+    # duplicate push), its old slot is cleared
+    #
+    def push(self, addr):
+        if (self.code.is_covered(addr)):
+            return
+        stack = self.stack
+        i = self.queued.get(addr)
+        if (i is not None):
+            stack[i] = dead_entry
+        self.queued[addr] = len(stack)
+        stack.append(addr)
+
+    ###############################################################
+    # Walk the code from the addresses of the worklist until a stop
+    # instruction, a covered address or a data range. Each instruction is
+    # decoded once here: its length, branch destination and callers are
+    # recorded, skips and destinations are pushed on the worklist.
+    #
+    def analyze_coverage(self):
+        code = self.code
+        stack = self.stack
+        queued = self.queued
+        push = self.push
+        data = self.data_ranges if (self.data_ranges) else ()
+        covered = code.covered
+        present = code.present
+        words = code.words
+        length = code.length
+        dummy = code.dummy
+        dests = code.dest
+        decode_table = self.defs.decode_table
+        operand_table = self.defs.operand_table
+        nwords = len(covered)
+        covered_extra = code.covered_extra
+        pops = 0
+        moved = 0
+        decoded = 0
+        nils = 0
+
+        while (stack):
+            addr = stack.pop()
+            pops += 1
+            if (addr == dead_entry):
+                moved += 1
+                continue
+            del queued[addr]
+            if (code.is_covered(addr) or (addr in data)):
+                continue
+            while True:
+                if ((addr >= 0) and ((addr & 1) == 0) and ((addr >> 1) < nwords)):
+                    w = words[addr >> 1] if (present[addr >> 1]) else (0xffff if (addr in dummy) else -1)
+                    if (w >= 0):
+                        covered[addr >> 1] = 1
+                else:
+                    w = 0xffff if (addr in dummy) else -1
+                    if (w >= 0):
+                        covered_extra.add(addr)
+                if (w < 0):             # word is not programmed read as 0xffff (nil)
+                    addr, n = self.walk_blank(addr)
+                    nils += n
+                else:
+                    k = decode_table[w]
+                    opc = operand_table[k] if (k != 0xFF) else unknown_opcode
+                    decoded += 1
+                    if (addr in dummy):
+                        dummy[addr] = True
+                    else:
+                        length[addr >> 1] = opc.bytes   # 2 bytes by default, 4 for dword instructions
+                    if (opc.skip):
+                        push(addr + 4)
+                    if (debug):
+                        print(self.hexc(w), opc.template)
+                    if (opc.bytes == 4):
+                        code.lookup_adr(addr + 2)
+                    if (opc.target):
+                        dest = opc.target(addr, w, code.word_at(addr + 2) if (opc.bytes == 4) else 0)
+                        if ((dest >= 0) and ((dest >> 1) < nwords)):
+                            push(dest)
+                            code.lookup_adr(dest)
+                            code.add_call(dest, addr)
+                        else:                           # not walked, no dummy
+                            code.add_external(dest, addr)
+                        dests[addr] = dest
+                    if (opc.stop):
+                        break
+                    addr = (addr + opc.bytes) & 0xfffff
+                if ((addr >= 0) and ((addr & 1) == 0) and ((addr >> 1) < nwords)):
+                    if (covered[addr >> 1]):
+                        break           # stop if address is already covered
+                elif (code.is_covered(addr)):
+                    break
+                if (addr in data):
+                    break
 
-        while (byte_addr <= (max_addr + 1)):
+        self.count('coverage stack pushes', pops)       # every push is popped once
+        self.count('coverage stack pops', pops)
+        self.count('coverage pushes moved up', moved)
+        self.count('words decoded', decoded)
+        self.count('nil words walked', nils)
+
+    ###############################################################
+    # Cover the run of nil words (not programmed, not dummies) from `addr`
+    # at once, as the coverage walk did word by word: up to a programmed
+    # word, a dummy, a covered address or a data range. Wraps around the
+    # 20 bit address space. The run is kept as ranges in code.nil_runs,
+    # split at the end of the image. Returns (address after the run, nil words)
+    #
+    def walk_blank(self, addr):
+        code = self.code
+        covered = code.covered
+        present = code.present
+        n = 0
+        while ((addr >= 0) and ((addr & 1) == 0)):
+            i = addr >> 1
+            if (i < len(covered)):
+                top = min(len(covered), 0x80000) if (i < 0x80000) else len(covered)    # words below the wrap around
+                end = present.find(1, i, top)
+                if (end < 0):
+                    end = top
+                c = covered.find(1, i, end)
+                if (c >= 0):
+                    end = c
+                stop = self.blank_stop(addr, end * 2)
+                covered[i:stop >> 1] = b'\x01' * ((stop >> 1) - i)
+                wrap = top * 2
+            else:
+                stop = self.blank_stop(addr, 0x100000)
+                wrap = 0x100000
+            if (stop > addr):
+                code.nil_runs[addr] = stop
+                if (i >= len(covered)):
+                    code.nil_extra.append((addr, stop))
+                n += (stop - addr) >> 1
+            addr = stop & 0xfffff
+            if (stop < wrap):
+                break
+        return addr, n
+
+    # Return the first dummy or data range address from `lo` up to `hi`,
+    # or covered address outside of the image, else `hi`
+    def blank_stop(self, lo, hi):
+        code = self.code
+        stop = min((a for a in code.dummy if ((lo <= a) and (a < hi))), default=hi)
+        stop = self.data_ranges.first(lo, stop)
+        if (hi > len(code.covered) * 2):
+            stop = min((a for a, end in code.nil_extra if ((lo <= a) and (a < stop))), default=stop)
+        return stop
+
+    ###############################################################
+    # Code coverage from every word of the code ranges (jump tables),
+    # walked from the interval set, highest address first
+    #
+    def analyze_ranges(self):
+        code = self.code
+        for addr in self.code_ranges.addresses(reverse=True):
+            if (not code.is_covered(addr)):
+                self.push(addr)
+                self.analyze_coverage()
+
+    # Yield the entry points of the code coverage, the words of the code
+    # ranges first
+    def entry_points(self):
+        yield from self.code_ranges.addresses()
+        for sti in self.entries:
+            yield sti.addr
+
+    ###############################################################
+    # Group the instructions decoded by the coverage into
+    # basic blocks, with their successor, predecessor and call edges.
+    # A block starts at an entry point, a destination, after a branch or
+    # skip, or where the covered code is not contiguous; it ends after a
+    # stop, branch or skip instruction. A run of nil words is not decoded
+    # word by word, it is taken as one nop as long as the run (split at
+    # the entry points and skip destinations in it)
+    #
+    def build_cfg(self):
+        code = self.code
+        addresses = list(code.covered_addresses())
+        if (code.nil_runs):
+            addresses.extend(code.nil_runs)
+            addresses.sort()
+        blocks = self.make_blocks(addresses, set(self.entry_points()))
+        for block in blocks.values():
+            for dest, kind in block.succ:
+                blocks[dest].pred.append((block.start, kind))
+            for dest in block.calls:
+                blocks[dest].pred.append((block.start, 'call'))
+        code.blocks = blocks
+        self.count('basic blocks', len(blocks))
+
+    # Return the basic blocks of the covered `addresses` (ascending, nil
+    # runs by their start) without their predecessors. `leaders` are the
+    # block starts known beforehand, it gets the ones found here
+    def make_blocks(self, addresses, leaders):
+        code = self.code
+        matching_opcode = self.defs.matching_opcode
+        word_at = code.word_at
+        dests = code.dest
+        nil_runs = code.nil_runs
+        data = self.data_ranges         # not covered, edges into data ranges are left out
+        flow = []                       # (opcode, word, [(destination, kind)]) per address
+        runs = []                       # the nil runs of `addresses`
+        for i, addr in enumerate(addresses):
+            if (addr in nil_runs):      # nil words read as 0xffff
+                runs.append(addr)
+                w = 0xffff
+                opc = self.nil_opcode(nil_runs[addr] - addr)
+            else:
+                w = word_at(addr)
+                opc = matching_opcode(w)
+            edges = ()
+            if (opc.skip or (addr in dests)):
+                edges = []
+                if (opc.skip):
+                    edges.append((addr + 4, 'skip'))
+                if (addr in dests):
+                    edges.append((dests[addr], 'call' if opc.call else 'branch'))
+                edges = [(dest, kind) for dest, kind in edges if code.is_covered(dest)]  # not into data ranges, outside of the image
+                for dest, kind in edges:
+                    leaders.add(dest)
+                    if ((kind != 'call') and not opc.stop):
+                        leaders.add((addr + opc.bytes) & 0xfffff)
+            flow.append((opc, w, edges))
+            nxt = (addr + opc.bytes) & 0xfffff
+            if ((not opc.stop) and ((nxt != addr + opc.bytes) or (i + 1 == len(addresses)) or (addresses[i + 1] != nxt))):
+                leaders.add(nxt)        # not contiguous: overlapping dword or 20 bit wrap around
+
+        cuts = sorted(leaders)          # leaders in a nil run split it
+        split = [start for start in runs if (self.first_cut(cuts, start, nil_runs[start]) < nil_runs[start])]
+        if (split):
+            pieces = []
+            items = []
+            pos = 0
+            for addr in split:
+                i = bisect.bisect_left(addresses, addr, pos)
+                pieces.extend(addresses[pos:i])
+                items.extend(flow[pos:i])
+                end = nil_runs[addr]
+                while (addr < end):
+                    cut = self.first_cut(cuts, addr, end)
+                    pieces.append(addr)
+                    items.append((self.nil_opcode(cut - addr), 0xffff, ()))
+                    addr = cut
+                pos = i + 1
+            addresses = pieces + addresses[pos:]
+            flow = items + flow[pos:]
+
+        blocks = {}
+        block = None
+        last = {}                       # key=block start, value=index of its last instruction
+        for i, addr in enumerate(addresses):
+            opc, w, edges = flow[i]
+            if ((block is None) or (addr != block.end) or (addr in leaders)):
+                block = BasicBlock(addr)
+                blocks[addr] = block
+            block.end = addr + opc.bytes
+            last[block.start] = i
+            if (is_movlb(w) or ((w & 0x100) and opc.banked)):
+                block.events.append((addr, w))
+            ends = opc.stop or (((addr + opc.bytes) & 0xfffff) != block.end)
+            for dest, kind in edges:
+                if (kind == 'call'):
+                    block.calls.append(dest)
+                    block.events.append((addr, w))
+                else:
+                    ends = True
+            if (ends):
+                block = None
+
+        for block in blocks.values():
+            i = last[block.start]
+            opc, w, edges = flow[i]
+            block.last = addresses[i]
+            block.succ = [(dest, kind) for dest, kind in edges if (kind != 'call')]
+            nxt = (block.last + opc.bytes) & 0xfffff
+            if ((not opc.stop) and not (data and not code.is_covered(nxt))):
+                block.succ.append((nxt, 'next'))
+        return blocks
+
+    # Return the first of the ascending addresses `cuts` above `start` and
+    # below `end`, else `end`
+    def first_cut(self, cuts, start, end):
+        k = bisect.bisect_right(cuts, start)
+        return cuts[k] if ((k < len(cuts)) and (cuts[k] < end)) else end
+
+    # Return the nop standing for a run of `nbytes` bytes of nil words
+    def nil_opcode(self, nbytes):
+        opc = copy.copy(self.defs.matching_opcode(0xffff))
+        opc.bytes = nbytes
+        return opc
+
+    ###############################################################
+    # Bank dataflow over the basic blocks. The bank selected by movlb is
+    # propagated from the entry points along the block edges and into the
+    # called blocks. Where paths with different banks join, the bank
+    # becomes `bank_unknown`; a block is revisited only when its incoming
+    # bank changes, so at most twice. Banked operands get the SFR name of
+    # their bank, if known.
+    #
+    def analyze_banks(self):
+        code = self.code
+        blocks = code.blocks
+        seeds = [(addr, 0) for addr in self.code_ranges.addresses() if (addr in blocks)]    # not in a data range
+        seeds.extend((sti.addr, sti.bank) for sti in self.entries)
+        code.bank_in = {}
+        self.propagate_banks(code.bank_in, seeds)
+        for start, bank in code.bank_in.items():
+            for addr, txt in self.bank_comments(blocks[start], bank):
+                code.add_comment(addr, txt)
+
+    # Merge the (address, bank) `seeds` into `bank_in` and propagate the
+    # changed banks along the edges, only into the blocks of `scope` if given
+    def propagate_banks(self, bank_in, seeds, scope=None):
+        blocks = self.code.blocks
+        work = []
+
+        def merge(addr, bank):
+            if ((scope is not None) and (addr not in scope)):
+                return
+            old = bank_in.get(addr)
+            if (old is None):
+                bank_in[addr] = bank
+                work.append(addr)
+            elif ((old != bank) and (old != bank_unknown)):
+                bank_in[addr] = bank_unknown
+                work.append(addr)
+
+        for addr, bank in seeds:
+            merge(addr, bank)
+        while (work):
+            block = blocks[work.pop()]
+            for dest, bank in self.bank_edges(block, bank_in[block.start]):
+                merge(dest, bank)
+
+    # Yield (destination, bank) of the calls and the following blocks of
+    # `block` entered with `bank`
+    def bank_edges(self, block, bank):
+        dests = self.code.dest
+        for addr, w in block.events:
+            if (is_movlb(w)):
+                bank = w & 0xF
+            elif (addr in dests):       # call
+                yield dests[addr], bank
+        for dest, kind in block.succ:
+            yield dest, bank
+
+    # Yield (address, comment) of the SFR names of the banked operands of
+    # `block` entered with `bank`
+    def bank_comments(self, block, bank):
+        dests = self.code.dest
+        reg_names = self.reg_names
+        for addr, w in block.events:
+            if (is_movlb(w)):
+                bank = w & 0xF
+            elif ((bank != bank_unknown) and (addr not in dests)):  # banked, search for SFR name, add it to comment if found
+                reg_name = reg_names.get((w & 0xFF) | (bank << 8), '')
+                if (reg_name):
+                    yield addr, ' ' + reg_name
+
+    ###############################################################
+    # Return the call graph: key=entry address of each function (entry
+    # points and call destinations), value=sorted addresses it calls.
+    # The blocks of a function are followed up to the entry of another one
+    #
+    def call_graph(self):
+        blocks = self.code.blocks
+        functions = set(addr for addr in self.entry_points() if (addr in blocks))
+        for block in blocks.values():
+            functions.update(block.calls)
+        graph = {}
+        for entry in sorted(functions):
+            calls = set()
+            for block in self.function_blocks(entry, functions):
+                calls.update(block.calls)
+            graph[entry] = sorted(calls)
+        return graph
+
+    # Return the blocks of the function at `entry`: followed from it up to
+    # the entry of another function of `functions`
+    def function_blocks(self, entry, functions):
+        blocks = self.code.blocks
+        seen = set([entry])
+        work = [entry]
+        found = []
+        while (work):
+            block = blocks[work.pop()]
+            found.append(block)
+            for dest, kind in block.succ:
+                if ((dest not in seen) and (dest not in functions)):
+                    seen.add(dest)
+                    work.append(dest)
+        return found
+
+    ###############################################################
+    # Return the XrefIndex of the analyzed code, built on first use:
+    # the branches and calls of the coverage (code.dest) and the table
+    # pointer loads (source = the low byte movlw/addlw)
+    #
+    def xrefs(self):
+        if (self.xref is None):
+            code = self.code
+            kind = XrefIndex.kinds.index
+            refs = []
+            for addr, dest in code.dest.items():
+                if ((dest >= 0) and ((dest >> 1) < len(code.present))):
+                    refs.append((dest, addr, kind('call' if (self.decode(addr)[0].call) else 'branch')))
+            for table_addr, loads in code.tables.items():
+                refs.extend((table_addr, l_op_addr, kind('table')) for u_op_addr, h_op_addr, l_op_addr in loads)
+            self.xref = XrefIndex(refs, dict((dest, sorted(c)) for dest, c in code.external.items()))
+        return self.xref
+
+    # (target, source, kind) of the references made by the function at
+    # `entry` (an entry point or call destination), over all its blocks
+    def function_refs(self, entry):
+        blocks = self.code.blocks
+        if (entry not in blocks):
+            return []
+        functions = set(addr for addr in self.entry_points() if (addr in blocks))
+        for block in blocks.values():
+            functions.update(block.calls)
+        xref = self.xrefs()
+        refs = []
+        for block in sorted(self.function_blocks(entry, functions), key=lambda b: b.start):
+            refs.extend(xref.refs_from(block.start, block.end))
+        return refs
+
+    ###############################################################
+    # Write the control flow graph in Graphviz DOT format
+    #
+    def write_cfg_dot(self, otf):
+        styles = {'next': '', 'branch': ' [style=bold]', 'skip': ' [style=dotted]', 'call': ' [style=dashed]'}
+        otf.write('digraph cfg {\n\tnode [shape=box fontname=monospace];\n')
+        for block in sorted(self.code.blocks.values(), key=lambda b: b.start):
+            otf.write('\t"b%X" [label="%s\\n%05X-%05X"];\n' % (block.start, self.code.labels.get(block.start, makelabel(block.start)),
+                                                              block.start, block.end - 1))
+            for dest, kind in block.succ:
+                otf.write('\t"b%X" -> "b%X"%s;\n' % (block.start, dest, styles[kind]))
+            for dest in block.calls:
+                otf.write('\t"b%X" -> "b%X"%s;\n' % (block.start, dest, styles['call']))
+        otf.write('}\n')
+
+    ###############################################################
+    # Write the basic blocks and the call graph in JSON
+    #
+    def write_cfg_json(self, otf):
+        blocks = [{'start': b.start, 'end': b.end, 'succ': b.succ, 'pred': b.pred, 'calls': b.calls}
+                  for b in sorted(self.code.blocks.values(), key=lambda b: b.start)]
+        graph = [{'entry': entry, 'calls': calls} for entry, calls in self.call_graph().items()]
+        json.dump({'entries': list(self.entry_points()), 'blocks': blocks, 'functions': graph}, otf, indent=1)
+        otf.write('\n')
+
+    ###############################################################
+    # Write the control flow graph to `path`, DOT if it ends with .dot, JSON otherwise
+    #
+    def write_cfg(self, path):
+        otf = open(path, "w")
+        if (path.endswith('.dot')):
+            self.write_cfg_dot(otf)
+        else:
+            self.write_cfg_json(otf)
+        otf.close()
+
+    ###############################################################
+    # Structured export of the analysis. Yields one dict per record, in
+    # the order: image, config bytes, eeprom words, one line record per
+    # line of the assembly (instructions and db lines, address order),
+    # tables found by the table pointer analyze, db definitions matches
+    #
+    def iter_records(self):
+        code = self.code
+        yield {'type': 'image', 'device': self.defs.device.name, 'max_addr': self.max_addr,
+               'entries': list(self.entry_points())}
+        for addr in sorted(self.configuration):
+            yield {'type': 'config', 'addr': addr, 'name': self.conf_regs.get(addr, ''), 'value': self.configuration[addr]}
+        if (self.eeprom):
+            for addr, w in region_words(self.eeprom):
+                yield {'type': 'eeprom', 'addr': addr, 'word': w}
+
+        for addr, nbytes, covered, asm in self.iter_line_asm():
+            rec = {'type': 'line', 'addr': addr, 'word': code.word_at(addr), 'length': nbytes, 'covered': covered}
+            if (covered and (nbytes == 4)):
+                rec['word2'] = code.word_at(addr + 2)
+            fields = asm.split(None, 1)
+            rec['mnemonic'] = fields[0] if (fields) else ''
+            rec['operands'] = fields[1] if (len(fields) > 1) else ''
+            if (addr in code.dummy):
+                rec['dummy'] = True
+            if (addr in code.labels):
+                rec['label'] = code.labels[addr]
+            if (addr in code.calls):
+                rec['callers'] = sorted(code.calls[addr])
+            if (addr in code.comments):
+                rec['comment'] = code.comments[addr].strip()
+            yield rec
+
+        for addr in sorted(code.external):
+            yield {'type': 'external', 'addr': addr, 'callers': sorted(code.external[addr])}
+        for addr in sorted(code.tables):
+            yield {'type': 'table', 'addr': addr, 'label': maketablelabel(addr), 'loads': code.tables[addr]}
+        for byte_addr, k in code.matches:
+            yield {'type': 'match', 'addr': byte_addr, 'def': k, 'comment': self.table_defs[k].comment.strip()}
+
+    # Yield (address, bytes, covered, assembly text) of each line, as `iter_lines`
+    def iter_line_asm(self):
+        code = self.code
+        skip_till_addr = 0
+        for addr in code.addresses():
+            if (addr < skip_till_addr):
+                continue
+            if (addr in code.dummy):
+                nbytes = 2
+                covered = code.dummy[addr]
+                asm = self.render_line(addr) if (covered) else ''
+            else:
+                nbytes = code.length[addr >> 1]
+                covered = code.is_covered(addr)
+                asm = self.render_line(addr) if (covered) else self.db_line(addr, nbytes)[0]
+            yield addr, nbytes, covered, asm
+            skip_till_addr = addr + nbytes
+
+    def write_jsonl(self, otf):
+        write_chunks(otf, (json.dumps(rec, separators=(',', ':')) + '\n' for rec in self.iter_records()))
+
+    # Write the analysis as NumPy arrays (.npz), one column per field:
+    #   line_addr, line_word, line_word2, line_length, line_covered,
+    #   line_mnemonic (index in mnemonics), line_operands (text column)
+    #   label_addr, label_name (text column)
+    #   xref_target, xref_source, xref_kind (index in xref_kinds)
+    #                                 sorted by target (see `xrefs`)
+    #   external_target, external_source  destinations outside of the image
+    #   table_addr, table_loads       (n, 3) upper/high/low loads
+    #   match_addr, match_def, def_comment (text column)
+    #   config_addr, config_value
+    # A text column `x` is stored as x_text (utf-8 bytes) and x_offset, the
+    # start of each string and the end of the last one
+    #
+    def write_npz(self, path):
+        if (numpy is None):
+            raise RuntimeError('the .npz export needs numpy')
+        code = self.code
+        np = numpy
+        columns = {}
+        def text_column(name, strings):
+            data = [s.encode() for s in strings]
+            columns[name + '_text'] = np.frombuffer(b''.join(data), dtype=np.uint8)
+            columns[name + '_offset'] = np.cumsum([0] + [len(d) for d in data], dtype=np.uint64)
+
+        lines = list(self.iter_line_asm())
+        fields = [asm.split(None, 1) for addr, nbytes, covered, asm in lines]
+        mnemonics = sorted(set((f[0] if (f) else '') for f in fields))
+        mnemonic_index = dict((m, i) for i, m in enumerate(mnemonics))
+        columns['line_addr'] = np.array([l[0] for l in lines], dtype=np.uint32)
+        columns['line_word'] = np.array([code.word_at(l[0]) for l in lines], dtype=np.uint16)
+        columns['line_word2'] = np.array([code.word_at(l[0] + 2) if (l[2] and (l[1] == 4)) else 0 for l in lines], dtype=np.uint16)
+        columns['line_length'] = np.array([l[1] for l in lines], dtype=np.uint8)
+        columns['line_covered'] = np.array([bool(l[2]) for l in lines], dtype=bool)
+        columns['line_mnemonic'] = np.array([mnemonic_index[f[0] if (f) else ''] for f in fields], dtype=np.uint16)
+        columns['mnemonics'] = np.array(mnemonics, dtype=str)
+        text_column('line_operands', [(f[1] if (len(f) > 1) else '') for f in fields])
+
+        labels = sorted(code.labels.items())
+        columns['label_addr'] = np.array([a for a, l in labels], dtype=np.uint32)
+        text_column('label_name', [l for a, l in labels])
+        xref = self.xrefs()
+        columns['xref_target'] = np.frombuffer(xref.targets, dtype=np.int64).astype(np.uint32)
+        columns['xref_source'] = np.frombuffer(xref.sources, dtype=np.int64).astype(np.uint32)
+        columns['xref_kind'] = np.frombuffer(xref.kind, dtype=np.uint8)
+        columns['xref_kinds'] = np.array(XrefIndex.kinds, dtype=str)
+        external = sorted((target, source) for target, sources in xref.external.items() for source in sources)
+        columns['external_target'] = np.array([t for t, s in external], dtype=np.int64)
+        columns['external_source'] = np.array([s for t, s in external], dtype=np.uint32)
+        tables = [(a, loads) for a in sorted(code.tables) for loads in code.tables[a]]
+        columns['table_addr'] = np.array([a for a, loads in tables], dtype=np.uint32)
+        columns['table_loads'] = np.array([loads for a, loads in tables], dtype=np.uint32).reshape(-1, 3)
+        columns['match_addr'] = np.array([a for a, k in code.matches], dtype=np.uint32)
+        columns['match_def'] = np.array([k for a, k in code.matches], dtype=np.uint32)
+        text_column('def_comment', [t.comment.strip() for t in self.table_defs])
+        config = sorted(self.configuration.items())
+        columns['config_addr'] = np.array([a for a, v in config], dtype=np.uint32)
+        columns['config_value'] = np.array([v for a, v in config], dtype=np.uint8)
+        np.savez_compressed(path, **columns)
+
+    # Write the structured export to `path`, NumPy arrays if it ends
+    # with .npz, JSON Lines otherwise
+    def export(self, path):
+        if (path.endswith('.npz')):
+            self.write_npz(path)
+            return
+        otf = open(path, "w")
+        self.write_jsonl(otf)
+        otf.close()
+
+    ###############################################################
+    # Build the index used by the table pointer analyze, with one sweep
+    # over the covered code. Returns (codemap, tblptrs, literals):
+    # - codemap, one byte per word, 1 = covered code (see `is_code`)
+    # - tblptrs, ascending addresses of every movwf TBLPTRL/H/U
+    # - literals, set of addresses of every movlw/addlw
+    #
+    def make_tblptr_index(self):
+        code = self.code
+        codemap = code.code_map()
+        data = code.code_bytes()
+        tblptrs = [m.start() for m in re.finditer(rb'[\xf6-\xf8]\x6e', data)
+                   if (((m.start() & 1) == 0) and codemap[m.start() >> 1])]           # 0x6EF6 - 0x6EF8
+        literals = set(m.start() * 2 for m in re.finditer(rb'[\x0e\x0f]', data[1::2])
+                       if codemap[m.start()])                                          # (bin & 0xfe00) == 0x0e00
+        return codemap, tblptrs, literals
+
+    ###############################################################
+    # Backward search from the movwf TBLPTRx at `paddr` for the movlw/addlw
+    # loading its value, within the code run starting at `start`.
+    # Skips the COWBASIC carry handling (btfsc STATUS,C + addlw 1)
+    #
+    def find_tblptr_literal(self, paddr, start, tblptr_set, literals):
+        word_at = self.code.word_at
+        laddr = paddr - 2
+        lo = max(paddr - 18, start)
+        while ((laddr >= lo) and (laddr not in tblptr_set)):
+            if ((word_at(laddr) == 0x0F01) and ((laddr - 2) >= start) and (word_at(laddr - 2) == 0xB0D8)):
+                laddr = laddr - 4
+                continue
+            if (laddr in literals):
+                return laddr
+            laddr = laddr - 2
+        return None
+
+    ###############################################################
+    # Backward search from the movwf TBLPTRx at tblptrs[k] for the other
+    # pointer writes and the movlw/addlw loading them, within 100 bytes of
+    # contiguous code. Only reads the program, returns (notes, movwf_addr,
+    # op_addr): the comments to add, in order, and key=movwf word,
+    # value=address of the movwf / of the movlw/addlw
+    #
+    def tblptr_scan(self, k, tblptrs, codemap, tblptr_set, literals):
+        word_at = self.code.word_at
+        addr = tblptrs[k]
+        start = (codemap.rfind(0, 0, addr >> 1) + 1) * 2
+        lo = max(addr - 98, start)
+        notes = []
+        movwf_addr = {}                 # key=movwf word, value=address
+        op_addr = {}                    # key=movwf word, value=address of the movlw/addlw
+
+        j = k
+        while ((j >= 0) and (tblptrs[j] >= lo) and (len(op_addr) < 3)):
+            paddr = tblptrs[j]
+            w = word_at(paddr)
+            if (w not in op_addr):
+                movwf_addr[w] = paddr
+                notes.append((paddr, tblptr_names[w][0]))
+                laddr = self.find_tblptr_literal(paddr, start, tblptr_set, literals)
+                if (laddr is not None):
+                    notes.append((laddr, tblptr_names[w][1]))
+                    op_addr[w] = laddr
+            j = j - 1
+        return notes, movwf_addr, op_addr
+
+    ###############################################################
+    # The table pointer loading sequence ending at the movwf TBLPTRx at
+    # tblptrs[k]. Returns (notes, asm, table, bound): the comments to add,
+    # in order, the (address, text) of the replaced movlw/addlw, (table
+    # address, (upper, high, low) movlw/addlw) of a valid table, and the
+    # highest address still to analyze after a complete sequence, else None
+    #
+    def table_pointer_load(self, k, tblptrs, codemap, tblptr_set, literals):
+        code = self.code
+        word_at = code.word_at
+        notes, movwf_addr, op_addr = self.tblptr_scan(k, tblptrs, codemap, tblptr_set, literals)
+        if (len(op_addr) < 3):
+            return notes, [], None, None
+
+        u_op_addr = op_addr[0x6EF8]
+        h_op_addr = op_addr[0x6EF7]
+        l_op_addr = op_addr[0x6EF6]
+        bound = min(movwf_addr.values()) - 2
+
+        # calculate table address
+        table_addr = ((word_at(u_op_addr) & 0xff) << 16) | ((word_at(h_op_addr) & 0xff) << 8) | (word_at(l_op_addr) & 0xff)
+
+        if (not code.in_code(table_addr)):
+            self.info("Invalid table address found!!! %s" % table_addr)
+            notes = notes + [(u_op_addr, ' INVALID !!!'), (h_op_addr, ' INVALID !!!'), (l_op_addr, ' INVALID !!!')]
+            return notes, [], None, bound
+
+        # replace pointer loading opcodes with (low LABEL, high LABEL, upper LABEL)
+        label = maketablelabel(table_addr)
+        asm = [(u_op_addr, ('movlw' if ((word_at(u_op_addr) & 0xff00) == 0x0e00) else 'addlw') + '  low highword ' + label),
+               (h_op_addr, ('movlw' if ((word_at(h_op_addr) & 0xff00) == 0x0e00) else 'addlw') + '  high ' + label),
+               (l_op_addr, ('movlw' if ((word_at(l_op_addr) & 0xff00) == 0x0e00) else 'addlw') + '  low ' + label)]
+        return notes, asm, (table_addr, (u_op_addr, h_op_addr, l_op_addr)), bound
+
+    ###############################################################
+    # Find the table pointer loading sequences, from the last one down.
+    # A found sequence hides the pointer writes above its first movwf.
+    # The loads found are kept by the address of their last movwf in
+    # `scans` (see `patch_table_pointers`)
+    #
+    def analyze_table_pointers(self):
+        code = self.code
+        codemap, tblptrs, literals = self.make_tblptr_index()
+        tblptr_set = set(tblptrs)
+
+        #print("max_addr = %s" % max_addr)
+
+        bound = self.max_addr           # highest address still to analyze
+        scans = {}                      # key=movwf address, value=(bound before, table_pointer_load result)
+        tables = 0
+        k = len(tblptrs) - 1
+        while (k >= 0):
+            addr = tblptrs[k]
+            k = k - 1
+            if (addr > bound):
+                continue
 
-            # word address for searching
+            load = self.table_pointer_load(k + 1, tblptrs, codemap, tblptr_set, literals)
+            scans[addr] = (bound, load)
+            notes, asm, table, low = load
+            for a, txt in notes:
+                code.add_comment(a, txt)
+            if (table):
+                # add label to table
+                tables += 1
+                code.labels[table[0]] = maketablelabel(table[0])
+                code.tables.setdefault(table[0], []).append(table[1])
+                #print("Table label added %s" % code.labels[table_addr])
+                code.asm.update(asm)
+            if (low is not None):
+                bound = low
+
+        if (self.layers is not None):
+            self.layers['scans'] = scans
+        self.count('tblptr writes', len(tblptrs))
+        self.count('tblptr scans', len(scans))
+        self.count('tables found', tables)
+
+    ###############################################################
+    # Yield (address, bytes) for each run of contiguous words in `code`
+    # (including dummies) which are not covered, from `lo` up to `hi`
+    # (None = all)
+    #
+    def uncovered_runs(self, lo=0, hi=None):
+        code = self.code
+        n = len(code.present)
+        dummies = [a for a in code.dummy if ((a >= lo) and ((hi is None) or (a < hi)) and ((a & 1) == 0) and not code.is_covered(a))]
+        first = lo >> 1
+        top = max([n] + [(a >> 1) + 1 for a in dummies])
+        if (hi is not None):
+            top = min(top, (hi + 1) >> 1)
+        last = max(first, min(n, top))
+        usable = bytearray((int.from_bytes(code.present[first:last], 'little') &
+                            ~int.from_bytes(code.covered[first:last], 'little')).to_bytes(last - first, 'little'))
+        data = bytearray(code.code_bytes(first, last))
+        usable.extend(bytes(top - last))
+        data.extend(bytes(2 * (top - last)))
+        for a in dummies:                   # dummies are read as 0xffff
+            i = (a >> 1) - first
+            usable[i] = 1
+            data[i * 2:i * 2 + 2] = b'\xff\xff'
+
+        pos = 0
+        while True:
+            i = usable.find(1, pos)
+            if (i < 0):
+                break
+            j = usable.find(0, i)
+            if (j < 0):
+                j = len(usable)
+            yield (first + i) * 2, bytes(data[i * 2:j * 2])
+            pos = j
+
+    ###############################################################
+    # Return the (table index, byte address) matches of the db definitions
+    # `automaton` ending at data[lo:hi], in the uncovered run `data` at
+    # `base`. The search starts a longest pattern before `lo`, so a range
+    # of the run gives the same matches as the whole run
+    #
+    def db_matches(self, automaton, base, data, lo, hi):
+        goto, fail, out = automaton
+        lengths = [len(t.data) for t in self.table_defs]
+        top = self.max_addr + 1
+        hits = []
+        st = 0
+        for i in range(max(0, lo - max(lengths + [1]) + 1), hi):
+            b = data[i]
+            while (st and (b not in goto[st])):
+                st = fail[st]
+            st = goto[st].get(b, 0)
+            if ((i >= lo) and out[st]):
+                for k in out[st]:
+                    byte_addr = base + i + 1 - lengths[k]
+                    if ((i + 1 < len(data)) and (byte_addr <= top)):
+                        hits.append((k, byte_addr))
+        return hits
+
+    ###############################################################
+    # Search all db definitions in one pass over the uncovered bytes and add
+    # their comments as prefixlines. A table matches at even and odd byte
+    # offsets, and only if the byte following it is uncovered code too.
+    #
+    def search_table_def_matched(self):
+        code = self.code
+        table_defs = self.table_defs
+
+        automaton = make_pattern_automaton([t.data for t in table_defs])
+        if (self.layers is not None):
+            self.layers['automaton'] = automaton
+        hits = []                           # (table index, byte address)
+        scanned = 0
+        for base, data in self.uncovered_runs():
+            scanned += len(data)
+            hits.extend(self.db_matches(automaton, base, data, 0, len(data)))
+
+        hits.sort()   # same order as searching table by table
+        self.count('db pattern bytes scanned', scanned)
+        self.count('db pattern matches', len(hits))
+        code.matches = [(byte_addr, k) for k, byte_addr in hits]
+        for k, byte_addr in hits:
+            #print(" Pattern found at %s" % waddr)
             waddr = byte_addr & ~1
-            if ((waddr not in code) or (waddr in covered)):
-                byte_addr = byte_addr + 1
+            code.prefixlines[waddr] = self.db_prefixline(code.prefixlines.get(waddr, ''), k, byte_addr)
+
+    # Return `prefixline` followed by the comment of the match of db
+    # definition `k` at `byte_addr`
+    def db_prefixline(self, prefixline, k, byte_addr):
+        return prefixline + ('\n' if (prefixline) else '') + '\n' + (8 * ' ') + ';' + self.table_defs[k].comment + \
+            (' (with offset +1) ' if (byte_addr & 1) else '') + '\n'
+
+    ###############################################################
+    # Put labels, callers, ORGs and group the uncovered words into db lines
+    #
+    def arrange_code(self):
+        self.arrange_range(0, None)
+
+    # Arrange the lines from `start` up to `end` (None = all), `start`
+    # must be the start of a line
+    def arrange_range(self, start, end):
+        code = self.code
+        skip_till_wadr = start
+
+        for wadr in code.addresses(start, end):
+            if ((wadr < skip_till_wadr) or (wadr in code.dummy)):
                 continue
+            calls = code.calls.get(wadr)
+            if (calls):                             # put labels
+                code.labels[wadr] = makelabel(wadr)
+                code.add_comment(wadr, ' entry from: ' + ','.join(map(self.hexc, sorted(calls))))
+                if ((not self.listing) and (len(calls) > 1)):
+                    code.prefixlines[wadr] = code.prefixlines.get(wadr, '') + '\n'
+            if (not code.in_code(wadr - 2)):        # must put an ORG if not contiguous
+                code.prefixlines[wadr] = code.prefixlines.get(wadr, '') + '\n\t\tORG %s \n' % (self.hexc(wadr))
+                #print(' ORG', "%s" % (hexc(wadr)))
+
+            if (not code.is_covered(wadr)):
+                nbytes = 2
+                next_wadr = wadr + 2
+                while (nbytes < 16): # upto 16 bytes in one db
+                    if (not code.in_code(next_wadr)):
+                        break # break if there is no code
+                    if (code.is_covered(next_wadr)):
+                        break # break is db finishes
+                    if ((next_wadr in code.calls) or (next_wadr in code.labels) or (next_wadr in code.prefixlines)):
+                        break # break if db has label or comment or prefixline
+                    nbytes += 2
+                    next_wadr += 2
+                code.length[wadr >> 1] = nbytes
+            skip_till_wadr = wadr + code.length[wadr >> 1]
+
+    ###############################################################
+    # Run all analyze passes on the loaded image
+    #
+    # With `incremental`, the labels, comments and prefixlines are also
+    # kept as each pass leaves them, in `layers`
+    #
+    def analyze(self):
+        code = self.code
+        self.layers = {} if (self.incremental) else None
+        self.analyze_code()
+        if (self.incremental):
+            self.layers['code_comments'] = dict(code.comments)         # SFR names
+            self.layers['code_prefixlines'] = dict(code.prefixlines)   # jump table names, interrupt vectors
+        self.analyze_data()
+
+    ###############################################################
+    # Code coverage from the reset vector, jump tables and interrupt vectors
+    #
+    def analyze_code(self):
+        code = self.code
+        self.stack = array('q')
+        self.queued = {}
+        self.entries = []
+
+        for start_addr, stop_addr, kind, name in self.jumptable_defs:
+            if (name):
+                code.prefixlines[start_addr] = code.prefixlines.get(start_addr, '') + '; %s \n' % name
+
+        # set start condition
+        sti = StackItem()
+        sti.addr = 0
+        sti.bank = 0
+        self.push(sti.addr)
+        self.entries.append(sti)
 
-            matching = True
-            offset = 0
+        self.phase('Analyze code coverage...')
+        self.analyze_coverage()
+        self.analyze_ranges()
 
-            while (matching):
+        ##### Interrupt vectors #########################
 
-                waddr2 = (byte_addr + offset) & ~1
+        if (self.use_interrupt1 and code.in_code(0x0008)):
+            sti = StackItem()
+            sti.addr = 0x0008;
+            sti.bank = 0
+            self.push(sti.addr)
+            self.entries.append(sti)
 
-                if ((waddr2 not in code) or (waddr2 in covered)):
-                    matching = False
-                    break
+            self.phase('Analyze Interrupt vector 1...')
+            self.analyze_coverage();
 
-                if ((byte_addr + offset) & 0x01):
-                    byte = code[waddr2].bin >> 8
-                else:
-                    byte = code[waddr2].bin & 0xff
+            code.prefixlines[0x0008] = code.prefixlines.get(0x0008, '') + '; Interrupt vector 1 \n'
 
-                if (offset < len(t.data)):
-                    if (byte != t.data[offset]):
-                        matching = False
-                        break
+        if (self.use_interrupt2 and code.in_code(0x0018)):
 
-                else: # all bytes compared, matching is found
+            sti = StackItem()
+            sti.addr = 0x0018;
+            sti.bank = 0
+            self.push(sti.addr)
+            self.entries.append(sti)
+
+            self.phase('Analyze Interrupt vector 2...')
+            self.analyze_coverage();
+
+            code.prefixlines[0x0018] = code.prefixlines.get(0x0018, '') + '; Interrupt vector 2 \n'
+
+        self.phase('Building control flow graph...')
+        self.build_cfg()
+
+        self.phase('Analyze banks...')
+        self.analyze_banks()
+
+    ###############################################################
+    # Table pointers, db definitions and arranging, on the covered code
+    #
+    def analyze_data(self):
+        self.xref = None
+        code = self.code
+        layers = self.layers
+        self.phase('Analyze table pointers...')
+        self.analyze_table_pointers()
+        if (layers is not None):
+            layers['scan_comments'] = dict(code.comments)
+            layers['scan_labels'] = dict(code.labels)
+
+        self.phase('Searching for table definitions matches...');
+        self.search_table_def_matched()
+        if (layers is not None):
+            layers['db_prefixlines'] = dict(code.prefixlines)
+
+        self.phase('Arranging...')
+        self.arrange_code()
+
+    ###############################################################
+    # Return the db line text and its comment for `nbytes` bytes from `addr`
+    #
+    def db_line(self, addr, nbytes):
+        data = []
+        for a in range(addr, addr + nbytes, 2):
+            w = self.code.word_at(a)
+            data.append(w & 0xff)
+            data.append((w >> 8) & 0xff)
+        asm = '%s%s' % ('db'.ljust(5, ' '), ','.join(map(self.hexc2, data)))
+        comment = ';' + ''.join(map(ascii_char, data))
+        return asm, comment
+
+    ###############################################################
+    # Write the assembly file
+    #
+    def render(self, otf):
+        write_chunks(otf, self.iter_lines())
+
+    ###############################################################
+    # Yield the text of the assembly file, in address order
+    #
+    def iter_lines(self):
+        code = self.code
+        yield ';Generated by PICDIS18, Claudiu Chiculita, 2003.  http://www.ac.ugal.ro/staff/ckiku/software\n'
+        yield ';Processor selected with --device\n'
+        yield 'PROCESSOR %s\n' % self.defs.device.name
+        yield '\n'
+        yield '#include <xc.inc>\n'
+        yield '\n'
+        yield from self.eep_cfg_lines()
+        yield from self.external_lines()
+        yield 'PSECT RESETVEC, abs\n'
+        yield 'RESETVEC:\n\n'
+
+        prev_lines = self.lines if (self.dirty is not None) else None
+        dirty = self.dirty
+        lines = {} if self.incremental else None
+
+        skip_till_addr = 0;
+        for addr in code.addresses():
+            if (addr < skip_till_addr):
+                continue
+            nbytes = 2 if (addr in code.dummy) else code.length[addr >> 1]
+            txt = prev_lines.get(addr) if (prev_lines is not None) else None
+            if ((txt is None) or not dirty.isdisjoint(range(addr, addr + nbytes, 2))):
+                txt = self.line_text(addr, nbytes)
+            yield txt
+            if (lines is not None):
+                lines[addr] = txt
+            skip_till_addr = addr + nbytes;
+
+        yield 'END RESETVEC'
+        self.lines = lines
+        self.dirty = None
+
+    ###############################################################
+    # Return the text written for the line at `addr`, prefixlines included
+    #
+    def line_text(self, addr, nbytes):
+        code = self.code
+        if (addr in code.dummy):
+            asm = self.render_line(addr) if code.dummy[addr] else ''
+            comment = ';' + code.comments.get(addr, '')
+        elif (code.is_covered(addr)):
+            asm = self.render_line(addr)
+            comment = code.comments.get(addr, '')
+            if (comment):
+                comment = ';' + comment
+        else:
+            asm, comment = self.db_line(addr, nbytes)
+
+        if (self.listing):
+            txt = code.prefixlines.get(addr, '') # kjc: added prefixline
+            txt += '%05X %04X\t' % (int(addr), code.word_at(addr))
+        else:
+            txt = code.prefixlines.get(addr, '')
+
+        comment_spacing = ''
+        if (comment):
+            # use spaces before comment, up to column 72 for db lines and 32 otherwise
+            width = len(asm.expandtabs(tabsize)) if ('\t' in asm) else len(asm)
+            comment_spacing = ' ' * ((73 if (asm.startswith('db')) else 33) - width)
+
+        label = code.labels.get(addr, '    ')
+        return txt + '%s%s%s%s\n' % ((label + (':' if label.strip() else '')).ljust(10), asm, comment_spacing, fix_line_wrap(comment))
+
+    ###############################################################
+    # Incremental re-disassembly. Loads a new version of the image and
+    # patches the analysis of the previous one (see `patch_analysis`).
+    # When the programmed addresses changed, or the patch would reach a
+    # dummy or a run of nil words (see `patch_coverage`), the image is
+    # analyzed again in full.
+    # The next `render` reuses the lines whose words and annotations did
+    # not change.
+    # Returns the addresses of the changed program words
+    #
+    def update(self, objectfile, name=''):
+        old = self.code
+        layers = self.layers
+        entries = self.entries
+        xref = self.xref
+        if (isinstance(objectfile, (bytes, bytearray))):
+            self.load(objectfile, name)
+        else:
+            self.load_hex(objectfile)
+        if ((old is None) or (layers is None)):
+            self.analyze()
+            return None
+
+        code = self.code
+        changed = set(i >> 1 for i in diff_indexes(old.code_bytes(), code.code_bytes()))
+        changed.update(diff_indexes(old.present, code.present))
+        changed = [i * 2 for i in sorted(changed)]
+
+        if (code.present == old.present):
+            words = old.words           # the analysis of `old` is patched for the new words
+            old.words = code.words
+            self.code = old
+            self.entries = entries
+            dirty = self.patch_analysis(changed, words, xref)
+            if (dirty is not None):
+                self.dirty = dirty
+                return changed
+            old.words = words
+            self.code = code
+        self.analyze()
+
+        dirty = set(changed)
+        dirty.update(i * 2 for i in diff_indexes(old.covered, code.covered))
+        dirty.update(i * 2 for i in diff_indexes(old.length, code.length))
+        for name in ('labels', 'comments', 'prefixlines', 'asm', 'dummy'):
+            a = getattr(old, name)
+            b = getattr(code, name)
+            dirty.update(k for k in (a.keys() | b.keys()) if (a.get(k) != b.get(k)))
+        self.dirty = dirty
+        return changed
+
+    ###############################################################
+    # Patch the analysis for the new program words at the addresses
+    # `changed` (`words` are the previous ones): the code coverage of the
+    # blocks reading them and of the blocks depending on them, then each
+    # pass only around the addresses whose coverage, words or callers
+    # changed. `xref`, if built, gets the references of the patched code.
+    # Returns the addresses whose lines must be rendered again, or None
+    # if the coverage can not be patched (it is left as it was)
+    #
+    def patch_analysis(self, changed, words, xref):
+        code = self.code
+        covered = bytes(code.covered)       # the coverage of the previous analyze
+        length = bytes(code.length)
+        dummy = dict(code.dummy)
+
+        self.phase('Patching code coverage...')
+        cover = self.patch_coverage(changed, words)
+        if (cover is None):
+            code.covered[:] = covered
+            code.length[:] = length
+            code.dummy = dummy
+            return None
+        lost, walked, refs = cover
+        moved = lost.union(walked)          # instructions uncovered or walked again
+        for addr in walked:
+            refs.update(self.flow_targets(addr))
+            refs.update(code.calls.get(addr, ()))
+        touched = moved.union(changed)      # the words read differently
+
+        notes = set()
+        if (moved):
+            self.phase('Patching control flow graph...')
+            removed, added, repred = self.patch_cfg(moved, refs)
+            self.phase('Patching banks...')
+            notes = self.patch_banks(removed, added, repred)
+
+        self.phase('Patching table pointers...')
+        notes, asm, loads = self.patch_table_pointers(touched, notes)
+
+        self.phase('Patching table definitions matches...')
+        marks = moved.union(refs, notes, self.patch_table_defs(touched))
+
+        self.phase('Arranging...')
+        dirty = self.patch_arrange(marks, covered, length)
+        dirty.update(touched, asm)
+
+        if (xref is not None):
+            sources = moved.union(loads)
+            kind = XrefIndex.kinds.index
+            refs = []
+            for addr in sources:
+                dest = code.dest.get(addr)
+                if ((dest is not None) and (dest >= 0) and ((dest >> 1) < len(code.present))):
+                    refs.append((dest, addr, kind('call' if (self.decode(addr)[0].call) else 'branch')))
+            for table_addr, table_loads in code.tables.items():
+                refs.extend((table_addr, l_op_addr, kind('table')) for u_op_addr, h_op_addr, l_op_addr in table_loads
+                            if (l_op_addr in sources))
+            self.xref = xref.replace(sources, refs, dict((dest, sorted(c)) for dest, c in code.external.items()))
+        return dirty
+
+    # Return the addresses the instruction at `addr` flows to, decoded
+    # from `words` (None = the current ones): the next one, the skipped
+    # one and its destination
+    def flow_targets(self, addr, words=None):
+        code = self.code
+        if (words is None):
+            words = code.words
+        i = addr >> 1
+        w = words[i]
+        opc = self.defs.matching_opcode(w)
+        targets = set()
+        if (not opc.stop):
+            targets.add((addr + opc.bytes) & 0xfffff)
+        if (opc.skip):
+            targets.add(addr + 4)
+        if (opc.target):
+            w2 = 0
+            if (opc.bytes == 4):
+                w2 = words[i + 1] if (((i + 1) < len(code.present)) and code.present[i + 1]) else 0xffff
+            targets.add(opc.target(addr, w, w2))
+        return targets
+
+    ###############################################################
+    # Redo the code coverage of the covered instructions reading a word
+    # of `changed` (dwords included), decoded from the previous `words`
+    # and from the current ones. Their blocks are uncovered, and where they
+    # lost an edge the blocks no longer reached without them too; all are
+    # walked again from the entry points among them and from the edges of
+    # the other blocks into them.
+    # Returns (uncovered addresses, walked addresses, addresses flowing to
+    # or from the uncovered ones), or None where the walk order matters:
+    # the image has nil runs and dummies, or they would be uncovered or
+    # walked
+    #
+    def patch_coverage(self, changed, words):
+        code = self.code
+        blocks = code.blocks
+        covered = code.covered
+        present = code.present
+        length = code.length
+        dests = code.dest
+        nwords = len(covered)
+        starts = sorted(blocks)
+
+        def block_at(addr):             # start of the block holding the covered instruction at `addr`
+            return starts[bisect.bisect_right(starts, addr) - 1]
+
+        insns = set()
+        for addr in changed:
+            i = addr >> 1
+            if (covered[i] and present[i]):
+                insns.add(addr)
+            if ((i > 0) and covered[i - 1] and present[i - 1] and (length[i - 1] == 4)):
+                insns.add(addr - 2)
+        if (not insns):
+            return set(), set(), set()
+        if (code.nil_runs and any(((a & 1) == 0) for a in code.dummy)):
+            return None                 # a dummy is decoded or not as a nil run reached it first
+
+        entries = set(sti.addr for sti in self.entries)
+        redo = set(block_at(addr) for addr in insns)    # the blocks to uncover
+        if (any((self.flow_targets(addr, words) - self.flow_targets(addr)) for addr in insns)):
+            # an edge is lost: the blocks no longer reached without the changed ones go too
+            reached = set()
+            work = [addr for addr in entries.union(self.code_ranges.addresses()) if (addr in blocks)]
+            while (work):
+                start = work.pop()
+                if (start not in reached):
+                    reached.add(start)
+                    if (start not in redo):
+                        block = blocks[start]
+                        work.extend(dest for dest, kind in block.succ)
+                        work.extend(block.calls)
+            redo.update(start for start in blocks if (start not in reached))
+
+        for start in redo:
+            block = blocks[start]
+            addr = start
+            while (addr < block.end):
+                i = addr >> 1
+                if ((i >= nwords) or (not present[i]) or (dests.get(addr) in code.dummy) or
+                        ((length[i] == 4) and ((addr + 2) in code.dummy))):
+                    return None         # dummies and nil runs are not uncovered
+                addr += length[i]
+
+        seeds = [start for start in redo if ((start in entries) or (start in self.code_ranges) or
+                                             any((src not in redo) for src, kind in blocks[start].pred))]
+        lost = set()
+        refs = set()
+        for start in redo:
+            block = blocks[start]
+            addr = start
+            while (addr < block.end):
+                i = addr >> 1
+                n = length[i]
+                lost.add(addr)
+                refs.update(self.flow_targets(addr, words))
+                refs.update(code.calls.get(addr, ()))
+                covered[i] = 0
+                length[i] = 0
+                if (addr in dests):
+                    dest = dests.pop(addr)
+                    table = code.calls if ((dest >= 0) and ((dest >> 1) < nwords)) else code.external
+                    table[dest].remove(addr)
+                    if (not table[dest]):
+                        del table[dest]
+                addr += n
+
+        dummy = dict(code.dummy)
+        extra = (len(code.nil_runs), len(code.covered_extra))
+        before = bytes(covered)
+        self.stack = array('q')
+        self.queued = {}
+        for start in seeds:
+            self.push(start)
+        self.analyze_coverage()
+        if ((code.dummy != dummy) or ((len(code.nil_runs), len(code.covered_extra)) != extra)):
+            return None
+        walked = set(i * 2 for i in diff_indexes(before, covered))
+        self.count('blocks uncovered', len(redo))
+        return lost, walked, refs
+
+    ###############################################################
+    # Build again the basic blocks around the instructions `moved`
+    # (uncovered or walked again) and the addresses `refs` flowing to or
+    # from them, in spans between block starts of both the previous and
+    # the current coverage. Returns (removed, added, repred): key=start,
+    # value=the previous / new BasicBlock of the spans, and the starts of
+    # the blocks whose predecessors changed
+    #
+    def patch_cfg(self, moved, refs):
+        code = self.code
+        blocks = code.blocks
+        starts = sorted(blocks)
+        entries = set(sti.addr for sti in self.entries)
+        marks = set(refs)
+        for addr in moved:
+            marks.update((addr, addr - 2, addr - 4))
+
+        spans = []                      # [lo, hi) rebuilt, lo and hi start a block before and after
+        for addr in sorted(a for a in marks if (a >= 0)):
+            if (spans and (addr < spans[-1][1])):
+                continue
+            k = bisect.bisect_right(starts, addr) - 1
+            while ((k >= 0) and not self.block_start(starts[k], entries)):
+                k -= 1
+            lo = starts[k] if (k >= 0) else 0
+            k = bisect.bisect_right(starts, addr)
+            while ((k < len(starts)) and not self.block_start(starts[k], entries)):
+                k += 1
+            hi = starts[k] if (k < len(starts)) else (1 << 24)
+            if (spans and (lo <= spans[-1][1])):
+                spans[-1][1] = hi
+            else:
+                spans.append([lo, hi])
+
+        removed = {}
+        added = {}
+        for lo, hi in spans:
+            for start in starts[bisect.bisect_left(starts, lo):bisect.bisect_left(starts, hi)]:
+                removed[start] = blocks.pop(start)
+            addresses = self.covered_span(lo, hi)
+            leaders = set([lo])
+            for addr in addresses:
+                if ((addr in entries) or (addr in self.code_ranges) or (addr in code.calls) or (addr in code.external)):
+                    leaders.add(addr)
+                if (addr in code.nil_runs):     # split at the entry points and destinations in the run
+                    end = code.nil_runs[addr]
+                    leaders.update(a for a in entries.union(code.calls, code.external) if ((addr < a) and (a < end)))
+                    leaders.update(a for a in self.code_ranges.addresses() if ((addr < a) and (a < end)))
+            prev = lo - 2               # a skip or dword before the span flows into it
+            if ((prev >= 0) and code.is_covered(prev) and code.in_code(prev) and (prev not in code.dummy)):
+                opc = self.defs.matching_opcode(code.word_at(prev))
+                if ((opc.skip and code.is_covered(lo + 2)) or ((opc.bytes == 4) and not opc.stop)):
+                    leaders.add(lo + 2)
+            added.update(self.make_blocks(addresses, leaders))
+        blocks.update(added)
+
+        into = {}                       # key=block start, value=added blocks flowing into it
+        for start, block in added.items():
+            for dest in self.block_targets(block):
+                into.setdefault(dest, set()).add(start)
+        targets = set(into).union(added)
+        for block in removed.values():
+            targets.update(self.block_targets(block))
+        repred = set()
+        for start in targets:
+            block = blocks.get(start)
+            if (block is None):
+                continue                # uncovered
+            old = removed.get(start) if (start in added) else block
+            sources = into.get(start, set())
+            if (old is not None):
+                sources = sources.union(src for src, kind in old.pred if (src not in removed))
+            pred = []
+            for src in sorted(sources):
+                source = blocks[src]
+                pred.extend((src, kind) for dest, kind in source.succ if (dest == start))
+                pred.extend((src, 'call') for dest in source.calls if (dest == start))
+            if ((old is None) or (pred != old.pred)):
+                repred.add(start)
+            block.pred = pred
+        self.count('blocks rebuilt', len(added))
+        return removed, added, repred
+
+    # Return the destinations of the edges of `block`
+    def block_targets(self, block):
+        return [dest for dest, kind in block.succ] + block.calls
+
+    # True if a basic block starts at `addr` for sure: a covered
+    # instruction not entered from the previous one, or a leader.
+    # Not known next to dummies and nil words
+    def block_start(self, addr, entries):
+        code = self.code
+        covered = code.covered
+        present = code.present
+        length = code.length
+        i = addr >> 1
+        if ((addr & 1) or (i >= len(covered)) or not (covered[i] and present[i])):
+            return False
+        prev = None                     # the previous covered instruction
+        for a in (addr - 2, addr - 4):
+            if (a >= 0):
+                if ((covered[a >> 1] and not present[a >> 1]) or (a in code.dummy)):
+                    return False
+                if ((prev is None) and covered[a >> 1]):
+                    prev = a
+        if ((prev is None) or (prev + length[prev >> 1] != addr)):
+            return True                 # not contiguous
+        opc = self.defs.matching_opcode(code.words[prev >> 1])
+        if (opc.stop or (opc.skip and code.is_covered(prev + 4)) or
+                ((prev in code.dest) and (not opc.call) and code.is_covered(code.dest[prev]))):
+            return True                 # the previous block ends before it
+        if ((addr in entries) or (addr in self.code_ranges) or (addr in code.calls)):
+            return True
+        if ((prev == addr - 2) and (addr >= 4) and covered[i - 2]):   # skip or dword at addr - 4
+            opc = self.defs.matching_opcode(code.words[i - 2])
+            return opc.skip or ((length[i - 2] == 4) and not opc.stop)
+        return False
+
+    # Return the addresses of the covered instructions and nil runs from
+    # `lo` up to `hi`, ascending (see `build_cfg`)
+    def covered_span(self, lo, hi):
+        code = self.code
+        covered = code.covered
+        present = code.present
+        nil_runs = code.nil_runs
+        top = min(len(covered), (hi + 1) >> 1)
+        addresses = []
+        i = covered.find(1, lo >> 1, top) if ((lo >> 1) < top) else -1
+        while (i >= 0):
+            addr = i * 2
+            if (present[i] or code.dummy.get(addr)):
+                addresses.append(addr)
+                i += 1
+            elif (addr in nil_runs):
+                addresses.append(addr)
+                i = nil_runs[addr] >> 1
+            else:
+                i += 1                  # in a nil run starting before `lo`
+            i = covered.find(1, i, top) if (i < top) else -1
+        addresses.extend(a for a in code.covered_extra if ((lo <= a) and (a < hi)))
+        addresses.extend(a for a, end in code.nil_extra if ((lo <= a) and (a < hi)))
+        addresses.sort()
+        return addresses
+
+    ###############################################################
+    # Redo the bank dataflow into the blocks `added` (replacing
+    # `removed`) that changed, the blocks `repred` and the blocks whose
+    # incoming bank depends on them: up to their first movlb. Their SFR
+    # name comments are put again in the 'code_comments' layer.
+    # Returns the addresses whose comment changed
+    #
+    def patch_banks(self, removed, added, repred):
+        code = self.code
+        blocks = code.blocks
+        dests = code.dest
+        bank_in = code.bank_in
+        comments = self.layers['code_comments']
+
+        redo = set(repred)
+        for start, block in added.items():
+            old = removed.get(start)
+            if ((old is None) or ((old.end, old.events, old.succ, old.calls) != (block.end, block.events, block.succ, block.calls))):
+                redo.add(start)
+        scope = set()                   # the blocks whose incoming bank is redone
+        work = list(redo)
+        while (work):
+            start = work.pop()
+            if (start in scope):
+                continue
+            scope.add(start)
+            block = blocks[start]
+            if (start in redo):
+                work.extend(dest for dest, bank in self.bank_edges(block, 0))
+                continue
+            selected = False            # the banks after a movlb do not depend on the incoming one
+            for addr, w in block.events:
+                if (is_movlb(w)):
+                    selected = True
+                    break
+                if (addr in dests):
+                    work.append(dests[addr])
+            if (not selected):
+                work.extend(dest for dest, kind in block.succ)
+
+        for start in scope.union(removed):
+            if ((start in scope) or (start not in blocks)):
+                bank_in.pop(start, None)
+        seeds = []
+        for src in set(src for start in scope for src, kind in blocks[start].pred if (src not in scope)):
+            if (src in bank_in):
+                seeds.extend(self.bank_edges(blocks[src], bank_in[src]))
+        seeds.extend((addr, 0) for addr in scope if (addr in self.code_ranges))
+        seeds.extend((sti.addr, sti.bank) for sti in self.entries if (sti.addr in scope))
+        self.propagate_banks(bank_in, seeds, scope)
+
+        marks = set()
+        for block in removed.values():
+            marks.update(addr for addr, w in block.events)
+        for start in scope:
+            marks.update(addr for addr, w in blocks[start].events)
+        previous = dict((addr, comments.pop(addr)) for addr in marks if (addr in comments))
+        for start in scope.union(added):
+            if (start in bank_in):
+                for addr, txt in self.bank_comments(blocks[start], bank_in[start]):
+                    marks.add(addr)
+                    comments[addr] = comments.get(addr, '') + txt
+        self.count('blocks bank redone', len(scope))
+        return set(addr for addr in marks if (previous.get(addr) != comments.get(addr)))
+
+    ###############################################################
+    # Redo the table pointer loads reading an address of `touched` (from
+    # 120 bytes below their last movwf), and the ones below them whose
+    # bound changed, keeping the others of the previous analyze. Their
+    # notes are put again in the comments of the 'scan_comments' layer,
+    # also at the addresses `notes` whose SFR comment changed.
+    # Returns (addresses whose comment or table label changed, addresses
+    # whose asm text changed, the low byte loads of the changed tables)
+    #
+    def patch_table_pointers(self, touched, notes):
+        code = self.code
+        layers = self.layers
+        scans = layers['scans']
+        codemap, tblptrs, literals = self.make_tblptr_index()
+        tblptr_set = set(tblptrs)
+        marks = sorted(touched)
+
+        def affected(m):                # the load ending at `m` reads an address of `touched`
+            k = bisect.bisect_left(marks, m - 120)
+            return (k < len(marks)) and (marks[k] <= m)
+
+        done = sorted(scans)            # the previous loads and the bound after each
+        bounds = []
+        for m in done:
+            bound, load = scans[m]
+            bounds.append(bound if (load[3] is None) else load[3])
+
+        def bound_at(m):                # the previous bound before the position `m`
+            k = bisect.bisect_right(done, m)
+            return bounds[k] if (k < len(done)) else self.max_addr
+
+        positions = sorted(tblptr_set.union(scans), reverse=True)
+        redo = [k for k, m in enumerate(positions) if affected(m)]
+        dropped = []
+        found = []
+        k = redo[0] if (redo) else len(positions)
+        bound = bound_at(positions[k]) if (redo) else 0
+        while (k < len(positions)):
+            m = positions[k]
+            if ((not affected(m)) and (bound == bound_at(m))):
+                j = bisect.bisect_right(redo, k)    # the same loads as before up to the next one affected
+                if (j == len(redo)):
                     break
+                k = redo[j]
+                bound = bound_at(positions[k])
+                continue
+            if (m in scans):
+                dropped.append(scans.pop(m)[1])
+            if ((m in tblptr_set) and (m <= bound)):
+                load = self.table_pointer_load(bisect.bisect_left(tblptrs, m), tblptrs, codemap, tblptr_set, literals)
+                scans[m] = (bound, load)
+                found.append(load)
+                if (load[3] is not None):
+                    bound = load[3]
+            k += 1
+
+        at = set(notes)
+        asm_at = set()
+        tables = set()
+        for load in dropped + found:
+            at.update(a for a, txt in load[0])
+            asm_at.update(a for a, txt in load[1])
+            if (load[2]):
+                tables.add(load[2][0])
+        done = sorted(scans)
+
+        def loads_at(a):                # the loads which may write at `a`, in the analyze order
+            return [scans[m][1] for m in reversed(done[bisect.bisect_left(done, a):bisect.bisect_right(done, a + 120)])]
+
+        changed = set()
+        comments = layers['code_comments']
+        scan_comments = layers['scan_comments']
+        for a in at:
+            txt = comments.get(a, '') + ''.join(t for load in loads_at(a) for a2, t in load[0] if (a2 == a))
+            if (txt != scan_comments.get(a, '')):
+                changed.add(a)
+            if (txt):
+                scan_comments[a] = txt
+            else:
+                scan_comments.pop(a, None)
+        moved = set()
+        for a in asm_at:
+            txt = None
+            for load in loads_at(a):
+                txt = dict(load[1]).get(a, txt)
+            if (txt != code.asm.get(a)):
+                moved.add(a)
+            if (txt is None):
+                code.asm.pop(a, None)
+            else:
+                code.asm[a] = txt
+        sources = set()
+        labels = layers['scan_labels']
+        for table_addr in tables:
+            loads = [scans[m][1][2][1] for m in reversed(done) if (scans[m][1][2] and (scans[m][1][2][0] == table_addr))]
+            previous = code.tables.get(table_addr, [])
+            sources.update(l_op_addr for u_op_addr, h_op_addr, l_op_addr in previous + loads)
+            if (loads != previous):
+                changed.add(table_addr)
+            if (loads):
+                code.tables[table_addr] = loads
+                labels[table_addr] = maketablelabel(table_addr)
+            else:
+                code.tables.pop(table_addr, None)
+                labels.pop(table_addr, None)
+        self.count('tblptr scans redone', len(found))
+        return changed, moved, sources
+
+    ###############################################################
+    # Redo the db definition matches ending near the addresses `touched`,
+    # their prefixlines are put again in the 'db_prefixlines' layer.
+    # Returns the addresses whose prefixline changed
+    #
+    def patch_table_defs(self, touched):
+        code = self.code
+        layers = self.layers
+        if ((not self.table_defs) or (not touched)):
+            return set()
+        automaton = layers['automaton']
+        lengths = [len(t.data) for t in self.table_defs]
+        longest = max(lengths + [1])
+        spans = []                      # [lo, hi) of the byte addresses where the redone matches end
+        for addr in sorted(touched):
+            lo = addr - 1
+            hi = addr + longest + 1
+            if (spans and (lo <= spans[-1][1])):
+                spans[-1][1] = max(spans[-1][1], hi)
+            else:
+                spans.append([lo, hi])
+
+        hits = []
+        for lo, hi in spans:
+            for base, data in self.uncovered_runs(max(0, lo - longest + 1) & ~1, hi + 2):
+                hits.extend(self.db_matches(automaton, base, data, max(0, lo - base), min(len(data), hi - base)))
+        ends = [lo for lo, hi in spans]
+
+        def redone(byte_addr, k):       # the match ends in a span
+            end = byte_addr + lengths[k] - 1
+            j = bisect.bisect_right(ends, end) - 1
+            return (j >= 0) and (end < spans[j][1])
+
+        at = set(byte_addr & ~1 for k, byte_addr in hits)
+        at.update(byte_addr & ~1 for byte_addr, k in code.matches if redone(byte_addr, k))
+        hits.extend((k, byte_addr) for byte_addr, k in code.matches if not redone(byte_addr, k))
+        hits.sort()
+        code.matches = [(byte_addr, k) for k, byte_addr in hits]
+
+        static = layers['code_prefixlines']
+        texts = dict((waddr, static.get(waddr, '')) for waddr in at)
+        for k, byte_addr in hits:
+            waddr = byte_addr & ~1
+            if (waddr in texts):
+                texts[waddr] = self.db_prefixline(texts[waddr], k, byte_addr)
+        prefixlines = layers['db_prefixlines']
+        changed = set()
+        for waddr, txt in texts.items():
+            if (txt != prefixlines.get(waddr, '')):
+                changed.add(waddr)
+            if (txt):
+                prefixlines[waddr] = txt
+            else:
+                prefixlines.pop(waddr, None)
+        return changed
+
+    ###############################################################
+    # Arrange again the lines around the addresses `marks`: from the line
+    # start at or below each one up to the next one above it, both line
+    # starts of the previous arrangement (`covered`, `length`) and of the
+    # current one, after a one word instruction not ending a dword.
+    # Returns the addresses of the lines arranged
+    #
+    def patch_arrange(self, marks, covered, length):
+        code = self.code
+        layers = self.layers
+        present = code.present
+        n = len(present)
+
+        def line_start(addr):
+            i = (addr >> 1) - 1
+            if (i < 0):
+                return True
+            if (i >= n):
+                return False
+            for c, l in ((covered, length), (code.covered, code.length)):
+                if ((not (present[i] and c[i] and (l[i] == 2))) or
+                        ((i > 0) and present[i - 1] and c[i - 1] and (l[i - 1] == 4))):
+                    return False
+            return True
+
+        windows = []
+        for addr in sorted(a for a in marks if (a >= 0)):
+            if (windows and ((windows[-1][1] is None) or (addr < windows[-1][1]))):
+                continue
+            start = min(addr & ~1, 2 * n)
+            while (not line_start(start)):
+                start -= 2
+            end = (addr & ~1) + 2
+            while ((end <= 2 * n) and not line_start(end)):
+                end += 2
+            if (end > 2 * n):
+                end = None
+            if (windows and (start <= windows[-1][1])):
+                windows[-1][1] = end
+            else:
+                windows.append([start, end])
+
+        labels = layers['scan_labels']
+        comments = layers['scan_comments']
+        prefixlines = layers['db_prefixlines']
+        lines = set()
+        for start, end in windows:
+            for addr in code.addresses(start, end):
+                lines.add(addr)
+                for table, layer in ((code.labels, labels), (code.comments, comments), (code.prefixlines, prefixlines)):
+                    if (addr in layer):
+                        table[addr] = layer[addr]
+                    else:
+                        table.pop(addr, None)
+                i = addr >> 1
+                if (((addr & 1) == 0) and (i < n) and present[i] and not code.covered[i]):
+                    code.length[i] = 0
+            self.arrange_range(start, end)
+        self.count('lines arranged', len(lines))
+        return lines
+
+    ###############################################################
+    # Disassemble `input_file`, then again each time it changes,
+    # with `update` (build-watch loop, stopped by ctrl-c)
+    #
+    def watch(self, input_file, output_file, interval=0.5):
+        self.disassemble(input_file, output_file)
+        mtime = os.stat(input_file).st_mtime_ns
+        while True:
+            time.sleep(interval)
+            try:
+                if (os.stat(input_file).st_mtime_ns == mtime):
+                    continue
+                mtime = os.stat(input_file).st_mtime_ns
+                t0 = time.perf_counter()
+                f = open(input_file, "rb")
+                try:
+                    data = f.read()                 # a copy, the file changes under a mapping
+                finally:
+                    f.close()
+                changed = self.update(data, input_file)
+                write_output(output_file, self.render)
+            except (OSError, ValueError) as e:      # eg. the hex file is being written
+                print('%s: %s' % (input_file, e), file=sys.stderr)
+                continue
+            print('Updated %s, %s words changed, %.3fs' % (os.path.abspath(output_file),
+                  ('all' if (changed is None) else len(changed)), time.perf_counter() - t0))
+
+    ###############################################################
+    # Disassemble one hex file into `output_file`
+    #
+    def disassemble(self, input_file, output_file):
+        self.phase('Reading object file...', os.path.abspath(input_file))
+        f = open(input_file, "rb")
+        try:
+            data = f.read() if (self.incremental) else map_file(f)   # `update` compares with the loaded copy
+        finally:
+            f.close()
+
+        # the output is only opened once there is something to write (see `write_output`)
+        key = self.cache_key(data, input_format(data, input_file)) if self.use_cache else None
+        if (key and write_output(output_file, lambda otf: result_cache_get(key, otf))):
+            self.phase('Cached result written...', output_name(output_file))
+        else:
+            self.load(data, input_file)
+
+            self.phase('Disassemble...')
+            self.analyze()
+
+            self.phase('Writing...', output_name(output_file))
+            write_output(output_file, self.render)
+            if (key and is_regular_output(output_file)):     # not a device or fifo to copy back
+                result_cache_put(key, output_file)
+        if (self.stats):
+            self.stats.add(self.counters)
+
+    ###############################################################
+    # Return the result cache key of the object file contents `data`
+    # in format `fmt`, with the current options, definitions and program version
+    #
+    def cache_key(self, data, fmt='hex'):
+        global source_digest
+        if (source_digest is None):
+            try:
+                f = open(__file__, "rb")
+                source_digest = hashlib.sha1(f.read()).hexdigest()
+                f.close()
+            except (OSError, NameError):
+                source_digest = ''
+        h = hashlib.sha1(data)
+        h.update(repr((source_digest, self.defs.digest, self.hexstyle, self.listing,
+                       self.use_interrupt1, self.use_interrupt2, fmt, self.base,
+                       [(t.comment, t.data) for t in self.table_defs], self.jumptable_defs)).encode())
+        return h.hexdigest()
+
+###############################################################
+# Batch mode. The definition tables are loaded once by the parent process
+# and handed to the workers, which disassemble one file per call
+#
+batch_options = {}      # Disassembler arguments of the batch worker
 
-                offset = offset + 1
+def batch_init(options):
+    global batch_options
+    batch_options = options
 
-            if (matching): # pattern found, add prefixline
-                #print(" Pattern found at %s" % waddr)
-                code[waddr].prefixline = code[waddr].prefixline + ('\n' if (code[waddr].prefixline) else '') + '\n' + (8 * ' ') + ';' + t.comment + \
-                    (' (with offset +1) ' if (byte_addr & 1) else '') + '\n'
+def batch_worker(input_file):
+    output_file = input_file[:-4] + '_.asm'
+    t0 = time.perf_counter()
+    try:
+        Disassembler(**batch_options).disassemble(input_file, output_file)
+        error = ''
+    except Exception as e:      # one bad file must not abort the batch
+        error = '%s: %s' % (type(e).__name__, e)
+    return input_file, error, time.perf_counter() - t0
+
+def run_batch(patterns, workers, options):
+    files = []
+    for p in patterns:
+        matched = sorted(glob.glob(p)) if glob.has_magic(p) else [p]
+        if (not matched):
+            print('No files matching %s' % p, file=sys.stderr)
+        files.extend(matched)
+
+    print('Disassembling %d files...' % len(files))
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=batch_init, initargs=(options,)) as pool:
+        results = list(pool.map(batch_worker, files))
+
+    failed = 0
+    for input_file, error, seconds in results:
+        print('%-6s %8.3fs  %s' % ('FAILED' if error else 'ok', seconds, input_file))
+        if (error):
+            print('                  %s' % error)
+            failed += 1
+    print('%d files, %d ok, %d failed, %.3fs' % (len(results), len(results) - failed, failed, time.perf_counter() - t0))
+    return failed
 
-            byte_addr = byte_addr + 1
+###############################################################
+# Server mode (--serve). An asyncio HTTP/1.1 server on a Unix socket or
+# a localhost port keeps the definitions loaded and hands each image to
+# a process pool whose workers have them loaded too:
+#   POST /disassemble?name=file.hex&hexstyle=1&listing=1&int1=1&int2=1
+#        &base=800&device=18F47Q10&format=asm|json|jsonl   body: the object file
+#   GET  /stats         requests served and their latency, as JSON
+# The timing of each request (queue wait, each phase, total) is given in
+# a Server-Timing header, and in the body with format=json
+#
+serve_options = {}      # Disassembler arguments of the requests without options (command line)
+serve_device = default_device
+serve_metrics = {'requests': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+serve_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+def serve_init(options, device):
+    global serve_options, serve_device
+    serve_options = options
+    serve_device = device
+    get_definitions(device=device)      # warm, the other devices are loaded on first use
+
+def serve_worker(data, name, params):
+    stats = Stats()
+    stats.phase('Loading')
+    options = dict(serve_options)
+    for key, option in (('hexstyle', 'hexstyle'), ('listing', 'listing'), ('int1', 'use_interrupt1'), ('int2', 'use_interrupt2')):
+        if (key in params):
+            options[option] = int(params[key])
+    if ('base' in params):
+        options['base'] = int(params['base'], 16)
+    options['defs'] = get_definitions(device=params.get('device', serve_device))
+    d = Disassembler(stats=stats, **options)
+    d.load(data, name)
+    d.analyze()
+    stats.phase('Writing')
+    otf = io.StringIO()
+    if (params.get('format') == 'jsonl'):
+        d.write_jsonl(otf)
+    else:
+        d.render(otf)
+    stats.phase(None)
+    return otf.getvalue(), stats.phases, d.counters
+
+async def serve_request(pool, method, path, body):
+    url = urllib.parse.urlsplit(path)
+    params = dict(urllib.parse.parse_qsl(url.query))
+    if (url.path == '/stats'):
+        return 200, 'application/json', json.dumps(serve_metrics), ''
+    if (url.path != '/disassemble'):
+        return 404, 'text/plain', 'Unknown path %s\n' % url.path, ''
+    if (method != 'POST'):
+        return 405, 'text/plain', 'Use POST with the object file as body\n', ''
+
+    t0 = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    try:
+        text, phases, counters = await loop.run_in_executor(pool, serve_worker, body, params.get('name', ''), params)
+    except (ValueError, KeyError, IndexError, struct.error) as e:   # bad object file or option
+        return 400, 'text/plain', '%s: %s\n' % (type(e).__name__, e), ''
+    total = time.perf_counter() - t0
+    work = sum(p[1] for p in phases)
+    timing = [('queue', total - work)] + [(name, seconds) for name, seconds, peak in phases] + [('total', total)]
+    header = ', '.join('%s;dur=%.3f' % (re.sub(r'\W+', '-', name.lower()).strip('-'), seconds * 1000) for name, seconds in timing)
+    serve_metrics['total_seconds'] += total
+    serve_metrics['max_seconds'] = max(serve_metrics['max_seconds'], total)
+    if (params.get('format', 'asm') == 'json'):
+        return 200, 'application/json', json.dumps({'asm': text, 'timing': dict(timing), 'counters': counters}), header
+    if (params.get('format') == 'jsonl'):
+        return 200, 'application/jsonl', text, header
+    return 200, 'text/plain; charset=utf-8', text, header
+
+async def serve_client(pool, reader, writer):
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                break
+            lines = head.decode('latin-1').split('\r\n')
+            try:
+                method, path, version = lines[0].split(' ')
+                headers = {}
+                for x in lines[1:]:
+                    if (':' in x):
+                        k, v = x.split(':', 1)
+                        headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get('content-length', '0')))
+            except (ValueError, asyncio.IncompleteReadError):
+                break
+            serve_metrics['requests'] += 1
+            try:
+                status, ctype, text, timing = await serve_request(pool, method, path, body)
+            except Exception as e:      # keep serving the other requests
+                status, ctype, text, timing = 500, 'text/plain', '%s: %s\n' % (type(e).__name__, e), ''
+            if (status != 200):
+                serve_metrics['errors'] += 1
+            data = text.encode()
+            close = (headers.get('connection', '').lower() == 'close') or (version == 'HTTP/1.0')
+            writer.write(('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n%s%s\r\n' %
+                          (status, serve_reasons[status], ctype, len(data),
+                           ('Server-Timing: %s\r\n' % timing) if (timing) else '',
+                           'Connection: close\r\n' if (close) else '')).encode())
+            for i in range(0, len(data), 1 << 16):     # stream, the client reads while we write
+                writer.write(data[i:i + (1 << 16)])
+                await writer.drain()
+            await writer.drain()
+            if (close):
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+# Serve on `address`: a port number or host:port (localhost HTTP),
+# otherwise the path of a Unix socket
+async def serve_main(address, workers, options, device=default_device):
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=serve_init, initargs=(options, device))
+    handler = lambda reader, writer: serve_client(pool, reader, writer)
+    if (re.fullmatch(r'(\S+:)?\d+', address)):
+        host, port = address.rsplit(':', 1) if (':' in address) else ('127.0.0.1', address)
+        server = await asyncio.start_server(handler, host, int(port))
+    else:
+        if (os.path.exists(address)):
+            os.unlink(address)          # left by a previous server
+        server = await asyncio.start_unix_server(handler, address)
+    print('Serving on %s with %d workers...' % (address, workers))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        pool.shutdown()
 
 ###############################################################
 # main entry to the program
@@ -715,185 +3543,169 @@ if __name__ == '__main__':
 
     table_defs_file = ''
     jumptable_defs_file = ''
-    use_interrupt1 = False
-    use_interrupt2 = False
+    batch = False
+    watch = False
+    graph_file = ''
+    workers = None
+    stats = None
+    stats_file = ''
+    profile_file = ''
+    device = default_device
+    serve_address = ''
+    export_file = ''
+    options = {'hexstyle': 0, 'listing': 0, 'table_defs': [], 'jumptable_defs': [],
+               'use_interrupt1': False, 'use_interrupt2': False, 'use_cache': True}
 
     try:
 
-        opts, args = getopt.getopt(sys.argv[1:], "hlo:d:j:", ["int1", "int2"])
+        opts, args = getopt.getopt(sys.argv[1:], "hlo:d:j:bw:", ["int1", "int2", "no-cache", "watch", "graph=", "base=", "stats", "stats-json=", "profile=", "device=", "serve=", "export="])
 
-        input_file = args[0]
+        input_file = args[0] if (args) else ''
         output_file = input_file[:-4] + '_.asm'
 
         for o, v in opts:
             if (o == '-o'):    # user-supplied output path
                 output_file = v
             elif (o == '-l'):
-                listing = 1
+                options['listing'] = 1
             elif (o == '-h'):
-                hexstyle = 1    # 0xNNN
+                options['hexstyle'] = 1    # 0xNNN
             elif (o == '-d'):
                 table_defs_file = v
             elif (o == '-j'):
                 jumptable_defs_file = v
+            elif (o == '-b'):
+                batch = True
+            elif (o == '-w'):
+                workers = int(v)
             elif (o == '--int1'):
-                use_interrupt1 = True
+                options['use_interrupt1'] = True
             elif (o == '--int2'):
-                use_interrupt1 = True
+                options['use_interrupt1'] = True
+            elif (o == '--no-cache'):
+                options['use_cache'] = False
+            elif (o == '--watch'):
+                watch = True
+            elif (o == '--graph'):
+                graph_file = v
+            elif (o == '--base'):
+                options['base'] = int(v, 16)
+            elif (o == '--stats'):
+                stats = Stats()
+            elif (o == '--stats-json'):
+                stats = Stats()
+                stats_file = v
+            elif (o == '--profile'):
+                profile_file = v
+            elif (o == '--device'):
+                device = v
+            elif (o == '--serve'):
+                serve_address = v
+            elif (o == '--export'):
+                export_file = v
+        if (export_file and (batch or watch)):
+            raise getopt.GetoptError('--export can not be used with -b or --watch')
+        if (export_file.endswith('.npz') and (numpy is None)):
+            raise getopt.GetoptError('the .npz export needs numpy')
+        if (serve_address and (args or batch or watch or graph_file or stats or profile_file or export_file)):
+            raise getopt.GetoptError('--serve takes no file and can not be used with -b, --watch, --graph, --stats or --profile')
+        if (not (args or serve_address)):
+            raise getopt.GetoptError('no input file')
+        if (batch and ('-o' in [o for o, v in opts])):
+            raise getopt.GetoptError('-o can not be used with -b')
+        if (batch and watch):
+            raise getopt.GetoptError('--watch can not be used with -b')
+        if (watch and (output_file == '-')):
+            raise getopt.GetoptError('--watch can not write to stdout')
+        if (graph_file and (batch or watch)):
+            raise getopt.GetoptError('--graph can not be used with -b or --watch')
+        if ((stats or profile_file) and (batch or watch)):
+            raise getopt.GetoptError('--stats and --profile can not be used with -b or --watch')
     except:
         print(__doc__)
         sys.exit(2)
 
+    log = sys.stderr if (output_file == '-') else sys.stdout     # keep stdout for the output
+
+    if (stats):
+        stats.phase('Reading definition files...')
+        options['stats'] = stats
+    profile = cProfile.Profile() if (profile_file) else None
+    if (profile):
+        profile.enable()
+
     if (table_defs_file != ''):
-        print('Reading table defs file...', os.path.abspath(table_defs_file))
+        print('Reading table defs file...', os.path.abspath(table_defs_file), file=log)
         try:
-            read_table_defs(open(table_defs_file, "r"))
+            options['table_defs'] = read_table_defs(open(table_defs_file, "r"))
         except OSError as e:
             print(f"Unable to open {table_defs_file}: {e}", file=sys.stderr)
             sys.exit(2)
 
     if (jumptable_defs_file != ''):
-        print('Reading jump-table table defs file...', os.path.abspath(jumptable_defs_file))
+        print('Reading jump-table table defs file...', os.path.abspath(jumptable_defs_file), file=log)
         try:
-            read_jumptable_defs(open(jumptable_defs_file, "r"))
+            options['jumptable_defs'] = read_jumptable_defs(open(jumptable_defs_file, "r"))
         except OSError as e:
             print(f"Unable to open {jumptable_defs_file}: {e}", file=sys.stderr)
             sys.exit(2)
 
-    print('Building tables...')
-    operand_table = make_operand_table()
-    reg_names = read_registry_names()
+    if (stats):
+        stats.phase('Building tables...')
+    print('Building tables...', file=log)
+    print('Reading config regs names...', device, file=log)
+    try:
+        options['defs'] = get_definitions(device=device)
+    except ValueError as e:             # unknown device
+        print(e, file=sys.stderr)
+        sys.exit(2)
 
-    print('Reading config regs names...')
-    read_conf_regs()
+    if (batch):
+        sys.exit(1 if run_batch(args, workers, options) else 0)
+    if (serve_address):
+        del options['defs'], options['use_cache']   # chosen per request
+        try:
+            asyncio.run(serve_main(serve_address, workers or os.cpu_count() or 1, options, device))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
 
-    print('Reading object file...', os.path.abspath(input_file))
     try:
-        read_object_code(open(input_file, "r"))
+        if (watch):
+            options['use_cache'] = False
+            Disassembler(verbose=1, incremental=True, **options).watch(input_file, output_file)
+        elif (graph_file or export_file):
+            options['use_cache'] = False
+            d = Disassembler(verbose=1, log=log, **options)
+            d.disassemble(input_file, output_file)
+            if (graph_file):
+                d.phase('Writing control flow graph...', os.path.abspath(graph_file))
+                d.write_cfg(graph_file)
+            if (export_file):
+                d.phase('Writing export...', os.path.abspath(export_file))
+                d.export(export_file)
+        else:
+            Disassembler(verbose=1, log=log, **options).disassemble(input_file, output_file)
+    except KeyboardInterrupt:
+        pass
+    except BrokenPipeError:             # stdout closed by the reader, eg. | head
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
     except OSError as e:
-            print(f"Unable to open {input_file}: {e}", file=sys.stderr)
+            print(f"Unable to open {e.filename}: {e}", file=sys.stderr)
             sys.exit(2)
 
-    print('Disassemble...')
-
-    tempk = list(code.keys())
-    tempk.sort()
-
-    max_addr = max(tempk);
-    #print('max_addr = %d' % int(max_addr))
-
-    # set start condition
-    sti = StackItem()
-    sti.addr = 0
-    sti.bank = 0
-    stack.append(sti)
-
-    print('Analyze code coverage...')
-    analyze_coverage()
-
-    ##### Interrupt vectors #########################
-
-    if (use_interrupt1 and (0x0008 in code)):
-        sti = StackItem()
-        sti.addr = 0x0008;
-        sti.bank = 0
-        stack.append(sti)
-
-        print('Analyze Interrupt vector 1...')
-        analyze_coverage();
-
-        code[0x0008].prefixline += '; Interrupt vector 1 \n'
-
-    if (use_interrupt2 and (0x0018 in code)):
-
-        sti = StackItem()
-        sti.addr = 0x0018;
-        sti.bank = 0
-        stack.append(sti)
-
-        print('Analyze Interrupt vector 2...')
-        analyze_coverage();
-
-        code[0x0018].prefixline += '; Interrupt vector 2 \n'
-
-    #################################################
-
-    print('Analyze table pointers...')
-    analyze_table_pointers()
-
-    print('Searching for table definitions matches...');
-    search_table_def_matched()
-
-    print('Arranging...')
-    skip_till_wadr = 0;
-
-    for wadr in tempk:
-        if (wadr < skip_till_wadr):
-            continue
-        cod = code[wadr]
-        if (len(cod.calls) > 0):                # put labels
-            cod.label = makelabel(wadr)
-            cod.comment += ' entry from: ' + ','.join(map(hexc, cod.calls))
-            if ((not listing) and (len(cod.calls) > 1)):
-                cod.prefixline += '\n'
-        if (len(cod.comment) < 3):              # remove empty comments
-            cod.comment = ''
-        if ((wadr - 2) not in code):            # must put an ORG if not contiguous
-            cod.prefixline += '\n\t\tORG %s \n' % (hexc(wadr))
-            #print(' ORG', "%s" % (hexc(wadr)))
-
-        if (wadr not in covered):
-            cod.asm = '%s%s,%s' % ('db'.ljust(5, ' '), hexc2(cod.bin & 0xff), hexc2((cod.bin >> 8) & 0xff))
-            cod.comment = ';%s%s' % (ascii_char(cod.bin & 0xff), ascii_char(cod.bin >> 8))
-            cod.bytes = 2
-            next_wadr = wadr + 2
-            while (cod.bytes < 16): # upto 16 bytes in one db
-                if (next_wadr not in code):
-                    break # break if there is no code
-                if (next_wadr in covered):
-                    break # break is db finishes
-                if ((len(code[next_wadr].calls) > 0) or code[next_wadr].label.strip() or code[next_wadr].prefixline):
-                    break # break if db has label or comment or prefixline
-                next_bin = code[next_wadr].bin
-                cod.asm += ',%s,%s' % (hexc2(next_bin & 0xff), hexc2((next_bin >> 8) & 0xff))
-                cod.comment += '%s%s' % (ascii_char(next_bin & 0xff), ascii_char(next_bin >> 8))
-                cod.bytes += 2
-                next_wadr += 2
-
-    print('Writing...', os.path.abspath(output_file))
-    otf = open(output_file, "w")
-    tempk = list(code.keys())
-    tempk.sort()
-    otf.write(';Generated by PICDIS18, Claudiu Chiculita, 2003.  http://www.ac.ugal.ro/staff/ckiku/software\n')
-    otf.write(';Select your processor\n')
-    otf.write('PROCESSOR 18F47K40; modify this\n')
-    otf.write('\n')
-    otf.write('#include <xc.inc>\n')
-    otf.write('\n')
-    otf.write(eep_cfg_txt())
-    otf.write('PSECT RESETVEC, abs\n');
-    otf.write('RESETVEC:\n\n');
-
-    skip_till_addr = 0;
-    for addr in tempk:
-        if (addr < skip_till_addr):
-            continue
-        if (listing):
-            otf.write(code[addr].prefixline) # kjc: added prefixline
-            otf.write('%05X %04X\t' % (int(addr), int(code[addr].bin)))
-        else:
-            otf.write(code[addr].prefixline)
-
-        comment_spacing = ''
-        if (code[addr].comment):
-            # use spaces before comment
-            comment_spacing = (' ' * int(((72 if (code[addr].asm.startswith('db')) else 32) + 3 - (2 + len(code[addr].asm.expandtabs(tabsize)))) / 1))
-        else:
-            comment = ''
-
-        otf.write('%s%s%s%s\n' % ((code[addr].label + (':' if code[addr].label.strip() else '')).ljust(10), code[addr].asm, comment_spacing, fix_line_wrap(code[addr].comment)))
-        skip_till_addr = addr + code[addr].bytes;
-
-    otf.write('END RESETVEC')
-    otf.close()
-    print('Done.')
+    if (profile):
+        profile.disable()
+        profile.dump_stats(profile_file)
+        print('Profile written...', os.path.abspath(profile_file), '(see python -m pstats)', file=log)
+    if (stats):
+        stats.phase(None)
+        tracemalloc.stop()
+        stats.write(log)
+        if (stats_file):
+            f = open(stats_file, "w")
+            stats.write_json(f)
+            f.close()
+            print('Statistics written...', os.path.abspath(stats_file), file=log)
+    print('Done.', file=log)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""BENCH.PY -- benchmark of the picdis18 pipeline on synthetic PIC18 images
+
+bench.py  [-s sizes] [-r repeats] [-S seed] [-k dir] [--save file] [--baseline file] [--tolerance pct]
+
+-s      comma separated image sizes in bytes, K and M suffixes allowed
+        (default: 64K,256K,1M,2M, at most 2M)
+-r n    runs of each size, the fastest time of each stage is kept (default: 3)
+-S n    seed of the image generator (default: 1)
+-k dir  keep the generated .hex images in dir
+--save file      write the stage timings to file (JSON), to be used as baseline
+--baseline file  compare the stage timings with a saved baseline, the exit
+                 status is 1 if a stage got slower than the tolerance
+--tolerance pct  allowed slow down against the baseline (default: 10)
+
+The images are generated from the opcode mix of opcodes18.txt: functions
+with conditional and relative branches inside them, call/rcall between
+them, movff/lfsr/call/goto double word instructions, movlb bank switches,
+TBLPTR loading sequences pointing to embedded string tables (some of them
+matching example_db.txt), and configuration bytes.
+The stages are timed as the phases of picdis18.Stats: reading the object
+code, code coverage, control flow graph, banks, table pointers, db
+definitions search, arranging and rendering.
+"""
+import getopt, os, sys, json, random, io, bisect
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import picdis18
+
+# instructions found more often than the others in compiled code
+common = ('movf', 'movwf', 'movlw', 'bcf', 'bsf', 'btfsc', 'btfss', 'clrf', 'incf', 'decf', 'addwf', 'andlw', 'iorwf', 'xorlw')
+
+strings = [b'Hello World', b'This is example', b'Error', b'Temperature: ', b'Voltage', b'OK\r\n', b'PIC18 benchmark image']
+
+###################################################################
+# Return the number of bytes of a size string like 64K, 2M or 0x1000
+#
+def parse_size(s):
+    s = s.strip().upper()
+    scale = 1
+    if (s.endswith('K')):
+        scale, s = 1 << 10, s[:-1]
+    elif (s.endswith('M')):
+        scale, s = 1 << 20, s[:-1]
+    return int(s, 0) * scale
+
+###################################################################
+# Synthetic image generator. The image is laid out as functions and
+# string tables, then the code of each function is emitted with its
+# branch and call destinations on instruction starts.
+#
+class ImageGenerator:
+    def __init__(self, defs, table_defs, seed):
+        self.defs = defs
+        self.rnd = random.Random(seed)
+        self.strings = strings + [bytes(t.data) for t in table_defs]
+        self.opcodes = {}               # key=mnemonic, value=Opcode
+        self.generic = []               # Opcode's without destination, not stopping, single word
+        for opc in defs.operand_table:
+            name = opc.template.split()[0]
+            self.opcodes.setdefault(name, opc)
+            if ((opc.target is None) and (not opc.stop) and (opc.bytes == 2) and
+                    (name not in (';nil', 'movlb', 'reset', 'sleep'))):
+                self.generic.extend([opc] * (4 if (name in common) else 1))
+
+    # Return a word of `opc` with random don't-care bits, which decodes to `opc`
+    def random_word(self, opc):
+        while True:
+            w = opc.value | (self.rnd.getrandbits(16) & ~opc.mask & 0xFFFF)
+            if (self.defs.matching_opcode(w) is opc):
+                return w
+
+    # Return the words of the branch/call `name` at `addr` to `dest`,
+    # None if `dest` is out of its range
+    def branch_words(self, name, addr, dest):
+        opc = self.opcodes[name]
+        n = (dest - addr - 2) >> 1
+        if (opc.template.endswith('N')):            # conditional, 8 bit offset
+            if (not (-128 <= n < 128)):
+                return None
+            words = [opc.value | (n & 0xFF)]
+        elif (opc.template.endswith('M')):          # bra, rcall, 11 bit offset
+            if (not (-1024 <= n < 1024)):
+                return None
+            words = [opc.value | (n & 0x7FF)]
+        else:                                       # call, goto, 20 bit word address
+            k = dest >> 1
+            words = [opc.value | (k & 0xFF), 0xF000 | ((k >> 8) & 0xFFF)]
+        assert (opc.target(addr, words[0], words[-1]) & 0x1FFFFF) == dest
+        return words
+
+    # Return the (start, end, kind) segments of an image of `size` bytes,
+    # kind is 'code' or 'table'
+    def layout(self, size):
+        rnd = self.rnd
+        segments = []
+        addr = 0
+        while (addr < size):
+            if (addr and (rnd.random() < 0.08)):
+                n = rnd.randrange(16, 240) & ~1
+                kind = 'table'
+            else:
+                n = rnd.randrange(40, 600) & ~1
+                kind = 'code'
+            end = min(addr + n, size)
+            segments.append((addr, end, kind))
+            addr = end
+        return segments
+
+    # Return the words of the function from `start` to `end`
+    def function(self, start, end, functions, tables):
+        rnd = self.rnd
+        slots = []                      # (addr, kind) of the instructions
+        addr = start
+        while (addr < end - 2):
+            k = rnd.random()
+            if ((k < 0.02) and (addr + 12 <= end - 2) and tables):
+                kind, n = 'tblptr', 12
+            elif ((k < 0.05) and (addr + 4 <= end - 2)):
+                kind, n = rnd.choice(('movff', 'lfsr')), 4
+            elif ((k < 0.09) and (addr + 4 <= end - 2)):
+                kind, n = 'call', 4
+            elif ((k < 0.10) and (addr + 4 <= end - 2)):
+                kind, n = 'goto', 4
+            elif (k < 0.12):
+                kind, n = 'rcall', 2
+            elif (k < 0.19):
+                kind, n = 'cond', 2
+            elif (k < 0.22):
+                kind, n = 'bra', 2
+            elif (k < 0.24):
+                kind, n = 'movlb', 2
+            else:
+                kind, n = 'generic', 2
+            slots.append((addr, kind))
+            addr += n
+        starts = [a for a, kind in slots]
+
+        words = []
+        for addr, kind in slots:
+            if (kind == 'tblptr'):
+                t = rnd.choice(tables)
+                for shift, reg in ((16, 0xF8), (8, 0xF7), (0, 0xF6)):
+                    words += [0x0E00 | ((t >> shift) & 0xFF), 0x6E00 | reg]
+            elif (kind in ('movff', 'lfsr')):
+                words += [self.random_word(self.opcodes[kind]), 0xF000 | rnd.getrandbits(12)]
+            elif (kind == 'movlb'):
+                words.append(0x0100 | rnd.randrange(16))
+            elif (kind == 'generic'):
+                words.append(self.random_word(rnd.choice(self.generic)))
+            else:
+                if (kind == 'call'):
+                    w = self.branch_words('call', addr, rnd.choice(functions))
+                elif (kind == 'goto'):
+                    w = self.branch_words('goto', addr, rnd.choice(starts))
+                elif (kind == 'rcall'):         # a near function
+                    i = bisect.bisect(functions, addr)
+                    w = self.branch_words('rcall', addr, functions[rnd.randrange(max(0, i - 4), min(len(functions), i + 4))])
+                else:
+                    name = rnd.choice(('bc', 'bn', 'bnc', 'bnn', 'bnov', 'bnz', 'bov', 'bz')) if (kind == 'cond') else 'bra'
+                    w = self.branch_words(name, addr, rnd.choice(starts))
+                if (w is None):                 # out of range
+                    w = [self.random_word(rnd.choice(self.generic))]
+                words += w
+        if (words and self.defs.matching_opcode(words[-1]).skip):
+            words[-1] = 0x0000          # nop, do not skip the return into the next segment
+        words.append(0x0012)            # return
+        return words
+
+    # Return the bytes of a string table from `start` to `end`
+    def table(self, start, end):
+        data = bytearray()
+        while (len(data) < end - start):
+            data += self.rnd.choice(self.strings) + b'\x00'
+        return bytes(data[:end - start])
+
+    # Return the program memory image of `size` bytes
+    def image(self, size):
+        segments = self.layout(size)
+        functions = [start for start, end, kind in segments if (kind == 'code')]
+        tables = [start for start, end, kind in segments if (kind == 'table')]
+        data = bytearray(b'\xff' * size)
+        for start, end, kind in segments:
+            if (kind == 'code'):
+                words = self.function(start, end, functions, tables)
+                data[start:start + 2 * len(words)] = b''.join(w.to_bytes(2, 'little') for w in words)
+            else:
+                data[start:end] = self.table(start, end)
+        return bytes(data)
+
+###################################################################
+# Return the Intel HEX text of the program memory image `data`,
+# with a few configuration bytes
+#
+def hex_text(data):
+    def record(addr, ty, payload):
+        rec = bytes([len(payload), (addr >> 8) & 0xFF, addr & 0xFF, ty]) + payload
+        return ':%s%02X\n' % (rec.hex().upper(), -sum(rec) & 0xFF)
+
+    lines = []
+    ext = -1
+    for addr in range(0, len(data), 16):
+        chunk = data[addr:addr + 16]
+        if (chunk == b'\xff' * len(chunk)):
+            continue                    # not programmed
+        if ((addr >> 16) != ext):
+            ext = addr >> 16
+            lines.append(record(0, 4, ext.to_bytes(2, 'big')))
+        lines.append(record(addr & 0xFFFF, 0, chunk))
+    lines.append(record(0, 4, b'\x00\x30'))
+    lines.append(record(0, 0, b'\x00\x8C\x1F\xFF\x3F\xFF'))
+    lines.append(record(0, 1, b''))
+    return ''.join(lines)
+
+###################################################################
+# Return key=stage, value=seconds of one disassembly of `text`
+#
+def run_once(text, table_defs):
+    stats = picdis18.Stats()
+    d = picdis18.Disassembler(picdis18.get_definitions(), table_defs=table_defs, stats=stats)
+    stats.phase('Reading object file')
+    d.load_hex(io.StringIO(text))
+    d.analyze()
+    stats.phase('Rendering')
+    d.render(io.StringIO())
+    stats.phase(None)
+    times = {}
+    for name, seconds, peak in stats.phases:
+        times[name] = times.get(name, 0) + seconds
+    return times, d.counters
+
+###################################################################
+# Print the timings of each size, against the baseline if given.
+# Return the number of stages slower than the tolerance
+#
+def report(results, baseline, tolerance):
+    slower = 0
+    for size, times in results.items():
+        base = baseline.get(size, {}) if (baseline) else {}
+        print('\n%s bytes' % size)
+        if (base):
+            print('%-44s %10s %10s %8s' % ('stage', 'seconds', 'baseline', 'ratio'))
+        else:
+            print('%-44s %10s' % ('stage', 'seconds'))
+        for stage, seconds in times.items():
+            if (stage in base):
+                ratio = seconds / base[stage] if (base[stage] > 0) else 1
+                flag = ''
+                if ((ratio > 1 + tolerance / 100) and (seconds - base[stage] > 0.005)):   # ignore timer noise
+                    flag = '  SLOWER'
+                    slower += 1
+                print('%-44s %10.4f %10.4f %8.2f%s' % (stage, seconds, base[stage], ratio, flag))
+            else:
+                print('%-44s %10.4f' % (stage, seconds))
+    return slower
+
+###############################################################
+# main entry to the program
+###############################################################
+if __name__ == '__main__':
+
+    sizes = ['64K', '256K', '1M', '2M']
+    repeats = 3
+    seed = 1
+    keep_dir = ''
+    save_file = ''
+    baseline_file = ''
+    tolerance = 10.0
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "s:r:S:k:", ["save=", "baseline=", "tolerance="])
+        for o, v in opts:
+            if (o == '-s'):
+                sizes = v.split(',')
+            elif (o == '-r'):
+                repeats = int(v)
+            elif (o == '-S'):
+                seed = int(v)
+            elif (o == '-k'):
+                keep_dir = os.path.abspath(v)
+            elif (o == '--save'):
+                save_file = os.path.abspath(v)
+            elif (o == '--baseline'):
+                baseline_file = os.path.abspath(v)
+            elif (o == '--tolerance'):
+                tolerance = float(v)
+        sizes = [parse_size(s) for s in sizes]
+        if (any(((s <= 0) or (s > 2 << 20)) for s in sizes)):
+            raise getopt.GetoptError('sizes from 1 byte to 2M')
+    except (getopt.GetoptError, ValueError):
+        print(__doc__)
+        sys.exit(2)
+    if (keep_dir):
+        os.makedirs(keep_dir, exist_ok=True)
+
+    os.chdir(root)                      # the definition files
+    table_defs = picdis18.read_table_defs(open('example_db.txt', "r"))
+    defs = picdis18.get_definitions()
+
+    results = {}
+    for size in sizes:
+        print('Generating %d bytes image...' % size)
+        text = hex_text(ImageGenerator(defs, table_defs, seed).image(size))
+        if (keep_dir):
+            f = open(os.path.join(keep_dir, 'bench_%d.hex' % size), "w")
+            f.write(text)
+            f.close()
+        best = {}
+        for i in range(repeats):
+            times, counters = run_once(text, table_defs)
+            for stage, seconds in times.items():
+                best[stage] = min(best.get(stage, seconds), seconds)
+        results[str(size)] = best
+        print('  %d words decoded, %d basic blocks, %d tables found' % (counters.get('words decoded', 0),
+              counters.get('basic blocks', 0), counters.get('tables found', 0)))
+
+    baseline = None
+    if (baseline_file):
+        f = open(baseline_file, "r")
+        baseline = json.load(f)['results']
+        f.close()
+    slower = report(results, baseline, tolerance)
+
+    if (save_file):
+        f = open(save_file, "w")
+        json.dump({'seed': seed, 'python': sys.version.split()[0], 'results': results}, f, indent=1)
+        f.write('\n')
+        f.close()
+        print('\nBaseline written...', save_file)
+    sys.exit(1 if slower else 0)